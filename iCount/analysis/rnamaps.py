@@ -391,14 +391,15 @@ def _process_read_group(xlink, chrom, strand, read, data, segmentation, metrics,
 
 
 def run(bam, segmentation, out_file, strange, cross_transcript, implicit_handling='closest',
-        mismatches=2, mapq_th=0, holesize_th=4, max_barcodes=10000):
+        mismatches=2, mapq_th=0, holesize_th=4, max_barcodes=10000, barcode_tag=None, threads=1,
+        reference=None):
     """
     Compute distribution of cross-links relative to genomic landmarks.
 
     Parameters
     ----------
     bam : str
-        BAM file with alligned reads.
+        BAM or CRAM file with alligned reads.
     segmentation : str
         GTF file with segmentation. Should be a file produced by function
         `get_segments`.
@@ -406,6 +407,7 @@ def run(bam, segmentation, out_file, strange, cross_transcript, implicit_handlin
         Output file with analysis results.
     strange : str
         File with strange propertieas obtained when processing bam file.
+        It is written as CRAM if name ends with .cram.
     cross_transcript : str
         File with reads spanning over multiple transcripts or multiple genes.
     implicit_handling : str
@@ -422,6 +424,14 @@ def run(bam, segmentation, out_file, strange, cross_transcript, implicit_handlin
     max_barcodes : int
         Skip merging similar barcodes if number of distinct barcodes at
         position is higher that this.
+    barcode_tag : str
+        Read randomers from this BAM tag (for example RX or BX) instead of
+        from read names.
+    threads : int
+        Number of threads used for BAM compression and decompression and
+        when input BAM file needs to be sorted.
+    reference : str
+        FASTA file with reference genome, needed for CRAM input or output.
 
 
     Returns
@@ -436,6 +446,8 @@ def run(bam, segmentation, out_file, strange, cross_transcript, implicit_handlin
     if implicit_handling not in ('closest', 'split'):
         raise ValueError(
             'Parameter implicit_handling should be one of "closest" or "split"')
+    if strange.endswith('.cram') and not reference:
+        raise ValueError('Parameter reference is needed to write CRAM file {}.'.format(strange))
 
     metrics = iCount.Metrics()
     metrics.cross_transcript = 0
@@ -447,24 +459,32 @@ def run(bam, segmentation, out_file, strange, cross_transcript, implicit_handlin
     data = {}
 
     progress = 0
+    # Hits on the same chromosome and strand are yielded in many batches, so
+    # sorted segmentation is kept until the chromosome changes.
+    segmentation_cache = {}
     LOGGER.info('Processing data...')
     # pylint: disable=protected-access
     for (chrom, strand), new_progress, by_pos in iCount.mapping.xlsites._processs_bam_file(
-            bam, metrics, mapq_th, strange, segmentation=segmentation, gap_th=holesize_th):
+            bam, metrics, mapq_th, strange, segmentation=segmentation, gap_th=holesize_th,
+            barcode_tag=barcode_tag, threads=threads, reference=reference):
 
         # pylint: disable=protected-access
         progress = iCount._log_progress(new_progress, progress, LOGGER)
 
-        # Sort all genes (and intergenic) by start coordinate.
-        segmentation_sorted = sorted(
-            iCount.genomes.segment._prepare_segmentation(segmentation, chrom, strand).items(),
-            key=lambda x: x[1]['gene_segment'].start)
+        if (chrom, strand) not in segmentation_cache:
+            segmentation_cache = {key: value for key, value in segmentation_cache.items()
+                                  if key[0] == chrom}
+            # Sort all genes (and intergenic) by start coordinate.
+            segmentation_cache[(chrom, strand)] = sorted(
+                iCount.genomes.segment._prepare_segmentation(segmentation, chrom, strand).items(),
+                key=lambda x: x[1]['gene_segment'].start)
+        segmentation_sorted = segmentation_cache[(chrom, strand)]
         seg_max_index = len(segmentation_sorted) - 1
         start_gene_index, stop_gene_index = 0, seg_max_index
 
         for xlink_pos, by_bc in sorted(by_pos.items()):
             # pylint: disable=protected-access
-            iCount.mapping.xlsites._merge_similar_randomers(by_bc, mismatches, max_barcodes)
+            iCount.mapping.randomers._merge_similar_randomers(by_bc, mismatches, max_barcodes)
             # by_bc is modified in place in _merge_similar_randomers
 
             # reads is a list of reads belonging to given barcode in by_bc
@@ -351,6 +351,9 @@ def main():
     make_parser_from_function(iCount.mapping.mapstar.run, subparsers,
                               module=iCount.mapping.mapstar)
     make_parser_from_function(iCount.mapping.xlsites.run, subparsers)
+    make_parser_from_function(iCount.mapping.xlsites_batch.run, subparsers)
+    make_parser_from_function(iCount.mapping.xlsites_state.xlsites_update, subparsers,
+                              only_func=True)
 
     # Analysis:
     make_parser_from_function(
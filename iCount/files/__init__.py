@@ -10,6 +10,9 @@ Parsing of `GTF`_ files is done with `pybedtools`_.
 .. autofunction:: iCount.files.gz_open
 .. autofunction:: iCount.files.decompress_to_tempfile
 
+.. automodule:: iCount.files.bam
+   :members:
+
 .. automodule:: iCount.files.bed
    :members:
 
@@ -50,6 +53,7 @@ import shutil
 
 import iCount
 
+from . import bam
 from . import bed
 from . import bedgraph
 from . import fasta
@@ -0,0 +1,93 @@
+""".. Line to protect from pydocstyle D205, D400.
+
+BAM
+---
+
+Reading sorted and indexed `BAM`_ and CRAM files.
+
+"""
+
+import os
+import logging
+
+import pysam
+from pysam import AlignmentFile  # pylint: disable=no-name-in-module
+
+import iCount
+
+LOGGER = logging.getLogger(__name__)
+
+
+def find_index(bam_fname):
+    """Return name of up-to-date index of ``bam_fname`` or None if there is no such index."""
+    root = os.path.splitext(bam_fname)[0]
+    for index in [bam_fname + '.bai', bam_fname + '.csi', bam_fname + '.crai', root + '.bai',
+                  root + '.csi']:
+        if os.path.isfile(index) and os.path.getmtime(index) >= os.path.getmtime(bam_fname):
+            return index
+    return None
+
+
+def ensure_sorted_indexed(bam_fname, sort_memory='768M', threads=1, reference=None):
+    """
+    Provide coordinate sorted and indexed BAM file with the content of ``bam_fname``.
+
+    If header of ``bam_fname`` declares it as coordinate sorted, file is read in
+    place. In such case, only index is made (into temporary file) if there is no
+    up-to-date index next to it. Otherwise, ``bam_fname`` is sorted into a
+    temporary BAM file with samtools external merge sort.
+
+    Parameters
+    ----------
+    bam_fname : str
+        BAM or CRAM file with mapped reads.
+    sort_memory : str
+        Maximum memory used per sorting thread (for example 768M or 2G).
+    threads : int
+        Number of threads used for sorting and indexing.
+    reference : str
+        FASTA file with reference genome, used to decode CRAM file.
+
+    Returns
+    -------
+    tuple
+        Name of sorted BAM file, name of its index and list of temporary files
+        that should be removed when done.
+
+    """
+    with AlignmentFile(bam_fname, 'rb', reference_filename=reference) as bamfile:
+        sort_order = bamfile.header.to_dict().get('HD', {}).get('SO')
+        is_cram = bamfile.is_cram
+
+    if sort_order == 'coordinate':
+        index = find_index(bam_fname)
+        if index:
+            LOGGER.info('Input BAM file is sorted and indexed, using it in place.')
+            return bam_fname, index, []
+
+        LOGGER.info('Input BAM file is sorted, indexing it...')
+        index = iCount.files.get_temp_file_name(extension='crai' if is_cram else 'bai')
+        pysam.index('-@', str(threads - 1), bam_fname, index)  # pylint: disable=no-member
+        return bam_fname, index, [index]
+
+    LOGGER.info('Sorting and indexing input BAM file...')
+    tmp_file = iCount.files.get_temp_file_name(extension='bam')
+    # pylint: disable=no-member
+    # Like in open_sorted, MD and NM tags are not added to decoded CRAM records.
+    options = ['--input-fmt-option', 'decode_md=0']
+    if reference:
+        options += ['--reference', reference]
+    pysam.sort('-m', sort_memory, '-@', str(threads - 1), *options, '-o', tmp_file, bam_fname)
+    pysam.index('-@', str(threads - 1), tmp_file)  # pylint: disable=no-member
+    return tmp_file, tmp_file + '.bai', [tmp_file, tmp_file + '.bai']
+
+
+def open_sorted(bam_fname, index, threads=1, reference=None):
+    """
+    Open sorted BAM or CRAM file ``bam_fname`` with index ``index`` for reading.
+
+    Tags MD and NM are not added when CRAM records are decoded, so skipped
+    records are written the same as they are stored in input file.
+    """
+    return AlignmentFile(bam_fname, 'rb', index_filename=index, threads=threads,
+                         reference_filename=reference, format_options=[b'decode_md=0'])
@@ -15,9 +15,29 @@ Mapping
 .. automodule:: iCount.mapping.xlsites
    :members:
 
+.. automodule:: iCount.mapping.xlsites_batch
+   :members:
+
+.. automodule:: iCount.mapping.xlsites_state
+   :members:
+
+.. automodule:: iCount.mapping.xlsites_common
+   :members:
+
+.. automodule:: iCount.mapping.xlsites_checkpoint
+   :members:
+
+.. automodule:: iCount.mapping.randomers
+   :members:
+
 """
 
 from . import filters
 from . import mapstar
 from . import indexstar
+from . import randomers
+from . import xlsites_checkpoint
+from . import xlsites_common
 from . import xlsites
+from . import xlsites_batch
+from . import xlsites_state
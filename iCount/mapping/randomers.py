@@ -0,0 +1,529 @@
+""".. Line to protect from pydocstyle D205, D400.
+
+Merge random barcodes
+---------------------
+
+Store hits of reads and merge similar random barcodes (randomers).
+
+Reads with the same random barcode on the same cross-link position come from
+the same cDNA molecule. Hits of such reads are stored in ``_Hits`` for each
+randomer. Because of sequencing errors, reads of the same cDNA molecule can
+have slightly different randomers. Randomers on the same position that differ
+in at most a given number of nucleotides are therefore merged with
+``_merge_similar_randomers`` before cDNA molecules are counted.
+"""
+import re
+import math
+import array
+import heapq
+import functools
+
+import numpy
+
+
+VALID_NUCLEOTIDES = set('ATCGN')
+RANDOM_BARCODE_REGEX = r'.*:rbc:([ATCGN]+).*'
+RANDOM_BARCODE_KEY = ':rbc:'
+LEADING_NUCLEOTIDES_REGEX = re.compile(r'[ATCGN]*')
+#: Number of distinct randomers for which parsing results are cached.
+RANDOMER_CACHE_SIZE = 2 ** 16
+
+#: Randomers on positions with at least this many distinct randomers are
+#: compared in bit-packed form with vectorized operations.
+VECTORIZE_MIN_BARCODES = 32
+NUCLEOTIDE_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+LOW_BITS = 0x5555555555555555  # Lower bit of each 2-bit nucleotide code in 64-bit integer
+POPCOUNT_TABLE = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+#: Number of values stored per hit: middle_pos, end_pos, read_len, num_mapped, second_start
+HIT_SIZE = 5
+#: Number of randomers tracked when counting the most frequent randomers.
+BARCODE_COUNTER_SIZE = 10000
+
+
+class _Hits:
+    """
+    Hits of reads with the same barcode on the same cross-link position.
+
+    Hits behave like a list of tuples ``(middle_pos, end_pos, read_len,
+    num_mapped, second_start)`` but are stored in a flat array of 64-bit
+    integers. This takes 40 bytes per hit instead of roughly 200 bytes for a
+    tuple of Python integers. Only appending hits, iteration and item access
+    are supported.
+    """
+
+    __slots__ = ('_values',)
+
+    def __init__(self, hits=()):
+        """Initialize with given hits."""
+        self._values = array.array('q')
+        self.extend(hits)
+
+    @classmethod
+    def frombytes(cls, data):
+        """Create hits from bytes, as returned by ``tobytes``."""
+        hits = cls()
+        hits._values.frombytes(data)
+        return hits
+
+    def tobytes(self):
+        """Return hits as bytes, for compact storage."""
+        return self._values.tobytes()
+
+    def append(self, hit):
+        """Append hit."""
+        self._values.extend(hit)
+
+    def extend(self, hits):
+        """Append all given hits."""
+        if isinstance(hits, _Hits):
+            self._values.extend(hits._values)
+        else:
+            for hit in hits:
+                self._values.extend(hit)
+
+    def __len__(self):
+        """Return number of hits."""
+        return len(self._values) // HIT_SIZE
+
+    def __iter__(self):
+        """Iterate over hits as tuples."""
+        values = iter(self._values)
+        return zip(*[values] * HIT_SIZE)
+
+    def __getitem__(self, index):
+        """Return hit on position ``index`` as tuple or hits in slice ``index``."""
+        if isinstance(index, slice):
+            return _Hits(self[i] for i in range(len(self))[index])
+        index = range(len(self))[index]
+        return tuple(self._values[index * HIT_SIZE:(index + 1) * HIT_SIZE])
+
+    def __eq__(self, other):
+        """Compare hits to another sequence of hits."""
+        if isinstance(other, _Hits):
+            return self._values == other._values
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        """Compare hits to another sequence of hits."""
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __copy__(self):
+        """Return copy of hits."""
+        hits = _Hits()
+        hits._values = array.array('q', self._values)
+        return hits
+
+    def __deepcopy__(self, memo):
+        """Return copy of hits, values are immutable integers."""
+        return self.__copy__()
+
+    def __repr__(self):
+        """Represent hits as list of tuples."""
+        return repr(list(self))
+
+
+class _BarcodeCounter(dict):
+    """
+    Counter of the most frequent randomers with bounded memory.
+
+    At most ``capacity`` randomers are tracked with Space-Saving algorithm.
+    Randomer that is not tracked yet replaces the tracked randomer with the
+    lowest count and takes over its count. Counts are therefore upper bounds,
+    overestimated by at most the number of counted records divided by
+    ``capacity``. Counts are exact as long as there are at most ``capacity``
+    distinct randomers. If ``capacity`` is 0, all randomers are counted
+    exactly.
+    """
+
+    def __init__(self, capacity=BARCODE_COUNTER_SIZE):
+        """Initialize empty counter."""
+        super().__init__()
+        self.capacity = capacity
+        # Heap with one (count, barcode) entry per tracked randomer. Counts in
+        # heap are updated lazily, so they can be lower than actual counts.
+        self._heap = []
+
+    def add(self, barcode):
+        """Count one occurrence of ``barcode``."""
+        if barcode in self:
+            self[barcode] += 1
+            return
+
+        count = 0
+        if self.capacity and len(self) >= self.capacity:
+            count = self._pop_min()
+        self[barcode] = count + 1
+        if self.capacity:
+            heapq.heappush(self._heap, (count + 1, barcode))
+
+    def _pop_min(self):
+        """Stop tracking randomer with the lowest count and return its count."""
+        while True:
+            count, barcode = self._heap[0]
+            if self[barcode] == count:
+                heapq.heappop(self._heap)
+                del self[barcode]
+                return count
+            heapq.heapreplace(self._heap, (self[barcode], barcode))
+
+    def merge(self, other):
+        """Add counts from ``other``, keeping ``capacity`` most frequent randomers."""
+        for barcode, count in other.items():
+            self[barcode] = self.get(barcode, 0) + count
+
+        if self.capacity:
+            if len(self) > self.capacity:
+                kept = self.most_common(self.capacity)
+                self.clear()
+                self.update((barcode, count) for count, barcode in kept)
+            self._heap = [(count, barcode) for barcode, count in self.items()]
+            heapq.heapify(self._heap)
+
+    def most_common(self, number):
+        """Return ``number`` of (count, barcode) pairs with largest counts."""
+        return heapq.nlargest(number, ((count, barcode) for barcode, count in self.items()))
+
+
+@functools.lru_cache(maxsize=RANDOMER_CACHE_SIZE)
+def _leading_randomer(text):
+    """Return the longest prefix of ``text`` made of valid nucleotides."""
+    return LEADING_NUCLEOTIDES_REGEX.match(text).group()
+
+
+@functools.lru_cache(maxsize=RANDOMER_CACHE_SIZE)
+def _is_valid_randomer(randomer):
+    """Check that ``randomer`` is made of valid nucleotides only."""
+    return not set(randomer) - VALID_NUCLEOTIDES
+
+
+def _get_random_barcode(query_name, metrics):
+    """
+    Extract random barcode from ``query_name``.
+
+    Randomer follows the last ``:rbc:`` in query name, as written by ``iCount
+    demultiplex``. Text after it repeats for reads with the same randomer, so
+    it is parsed only once. Regular expression ``RANDOM_BARCODE_REGEX`` is
+    only needed if the last ``:rbc:`` is not followed by a randomer.
+    """
+    index = query_name.rfind(RANDOM_BARCODE_KEY)
+    if index != -1:
+        barcode = _leading_randomer(query_name[index + len(RANDOM_BARCODE_KEY):])
+        if barcode:
+            return barcode
+
+    match = re.match(RANDOM_BARCODE_REGEX, query_name) if index != -1 else None
+    if match:
+        barcode = match.group(1)
+    elif ':' in query_name:
+        barcode = query_name.rsplit(':', 1)[1]
+        if not _is_valid_randomer(barcode):
+            # invalid barcode characters
+            barcode = ''
+            metrics.invalidrandomer_recs += 1
+    else:
+        barcode = ''
+        metrics.norandomer_recs += 1
+
+    return barcode
+
+
+def _get_tag_barcode(read, barcode_tag, metrics):
+    """Extract random barcode from tag ``barcode_tag`` of ``read``."""
+    if not read.has_tag(barcode_tag):
+        metrics.norandomer_recs += 1
+        return ''
+
+    barcode = str(read.get_tag(barcode_tag))
+    if not _is_valid_randomer(barcode):
+        # invalid barcode characters
+        metrics.invalidrandomer_recs += 1
+        return ''
+
+    return barcode
+
+
+def _match(seq1, seq2, mismatches):
+    """
+    Test if sequence seq1 and seq2 are sufficiently similar.
+
+    Parameters
+    ----------
+    seq1 : str
+        First sequence.
+    seq2 : str
+        Second sequence.
+    mismatches : int
+        Number of allowed mismatches between given sequences.
+
+    Returns
+    -------
+    bool
+        Do sequence `seq1` and `seq2` have less or equal than ``mismatches``
+
+    """
+    seq1, seq2 = seq1.upper(), seq2.upper()
+    matches = sum([(nuc1 == 'N' or nuc2 == 'N' or nuc1 == nuc2) for nuc1, nuc2 in zip(seq1, seq2)])
+    return max(len(seq1), len(seq2)) - matches <= mismatches
+
+
+def _encode_randomers(barcodes):
+    """
+    Encode randomers into 2-bit packed integers.
+
+    Nucleotide on i-th position of randomer is stored in bits 2i and 2i+1 of
+    randomer code. Mask has bit 2i set if i-th nucleotide is N or if randomer is
+    not longer than i. Such positions are ignored when comparing randomers.
+
+    Parameters
+    ----------
+    barcodes : list
+        Randomers to encode.
+
+    Returns
+    -------
+    tuple
+        Arrays with codes, masks and lengths of randomers. None is returned if
+        any of randomers is too long or has characters other than A, C, G, T
+        and N.
+
+    """
+    codes = numpy.zeros(len(barcodes), dtype=numpy.uint64)
+    masks = numpy.zeros(len(barcodes), dtype=numpy.uint64)
+    lengths = numpy.zeros(len(barcodes), dtype=numpy.int64)
+    for i, barcode in enumerate(barcodes):
+        if len(barcode) > 32:
+            return None
+        code, mask = 0, LOW_BITS & ~((1 << 2 * len(barcode)) - 1)
+        for j, nuc in enumerate(barcode.upper()):
+            if nuc == 'N':
+                mask |= 1 << 2 * j
+            elif nuc in NUCLEOTIDE_CODES:
+                code |= NUCLEOTIDE_CODES[nuc] << 2 * j
+            else:
+                return None
+        codes[i], masks[i], lengths[i] = code, mask, len(barcode)
+    return codes, masks, lengths
+
+
+def _popcount(values):
+    """Count set bits in each element of uint64 array."""
+    if hasattr(numpy, 'bitwise_count'):
+        return numpy.bitwise_count(values)  # pylint: disable=no-member
+    return POPCOUNT_TABLE[values.view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _count_mismatches(encoded, index, others):
+    """
+    Count mismatches between randomer ``index`` and each of randomers ``others``.
+
+    Randomers are encoded with ``_encode_randomers``. Number of mismatches is
+    the same as the one used by ``_match``: N matches any nucleotide and
+    difference in length counts as mismatches.
+    """
+    codes, masks, lengths = encoded
+    diff = codes[others] ^ codes[index]
+    diff = (diff | (diff >> numpy.uint64(1))) & ~(masks[others] | masks[index]) & \
+        numpy.uint64(LOW_BITS)
+    return _popcount(diff) + numpy.abs(lengths[others] - lengths[index])
+
+
+def _neighbours(barcode, mismatches, start=0):
+    """
+    Yield sequences that differ from ``barcode`` in 1 to ``mismatches`` positions.
+
+    Only positions from ``start`` on are changed. Each sequence is yielded once.
+    Nothing is yielded if ``mismatches`` is smaller than 1.
+    """
+    if mismatches < 1:
+        return
+    for i in range(start, len(barcode)):
+        for nuc in 'ACGT':
+            if nuc != barcode[i]:
+                neighbour = barcode[:i] + nuc + barcode[i + 1:]
+                yield neighbour
+                yield from _neighbours(neighbour, mismatches - 1, start=i + 1)
+
+
+def _merge_directional(by_bc, barcodes, counts, indexes, mismatches):
+    """
+    Merge randomers ``indexes`` in ``by_bc`` with directional network method.
+
+    Randomer A is connected to randomer B with equal length, that differs from
+    it in at most ``mismatches`` positions, if count of A is at least twice
+    the count of B minus one. Starting with most frequent randomers, all
+    randomers reachable from a randomer are merged into it. Neighbours of each
+    randomer are looked up in a dict of all randomers instead of comparing all
+    pairs of randomers, so time is proportional to the number of randomers.
+    """
+    by_seq = {barcodes[index]: index for index in indexes}
+    visited = set()
+    for root in sorted(indexes, key=lambda i: (counts[i], barcodes[i]), reverse=True):
+        if root in visited:
+            continue
+        visited.add(root)
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            for neighbour in _neighbours(barcodes[node], mismatches):
+                other = by_seq.get(neighbour)
+                if other is None or other in visited or counts[node] < 2 * counts[other] - 1:
+                    continue
+                visited.add(other)
+                stack.append(other)
+                by_bc[barcodes[root]].extend(by_bc.pop(barcodes[other]))
+
+
+def _merge_similar_randomers(by_bc, mismatches, max_barcodes, ratio_th=0.1, umi_method='ratio'):
+    """
+    Merge randomers on same site that are max ``mismatches`` different.
+
+    Input parameter `by_bc` has te following structure:
+    by_bc = {
+        'AAA': [(middle_pos, end_pos, read_len, num_mapped, second_start),  # hit1
+                (middle_pos, end_pos, read_len, num_mapped, second_start),  # hit2
+                (middle_pos, end_pos, read_len, num_mapped, second_start),  # ...
+        ]
+        'AAT': [(middle_pos, end_pos, read_len, num_mapped, second_start),  # hit1
+                (middle_pos, end_pos, read_len, num_mapped, second_start),  # hit2
+        ]
+
+    Steps in function:
+        0. Identify ambiguous randomers ('N' characters in barcode)
+
+        1. For each ambiguous randomer, identify similar non-ambiguous one. If
+        match is found, move hits form ambiguous to the non-ambiguous one. If no
+        match is found, declare ambiguous randomer (one that has 'N's) as
+        non-ambiguous anyway.
+
+        2. Identify and accept randomers with strong support.
+        Randomers that are supported by a threshold number of hits are accepted as
+        unique. Threshold is defined as the proportion (ratio_th) of the number of
+        reads assigned to the most frequent randomer.
+
+        3. Merge remaining.
+        For each barcode with number of reads below the threshold, identify if there
+        exists any similar one. If there is, join the hits form second barcode to
+        the first one.
+
+    If ``umi_method`` is 'directional', steps #2 and #3 are replaced by
+    ``_merge_directional``, which takes counts of both randomers into account
+    and never skips merging.
+
+    On positions with many distinct randomers (``VECTORIZE_MIN_BARCODES`` or
+    more), randomers are encoded as 2-bit packed integers and compared to many
+    others at once with NumPy bit operations. Results are the same as when
+    comparing them with ``_match``.
+
+    TODO: Code should be improved in step #1. Instead of finding any match,
+    match with least difference should be found. Check also the skipped unit
+    test in tests/test_xlsites.py
+
+    Parameters
+    ----------
+    by_bc : dict
+        Dictionary of barcodes and their hits.
+    mismatches : int
+        Reads on same position with random barcode differing less than
+        ``mismatches`` are grouped together.
+    max_barcodes : int
+        Skip step #3 if number of distinct barcodes is higher than this.
+    ratio_th : float
+        Threshold ratio used in step #2.
+    umi_method : str
+        Method of merging, 'ratio' or 'directional'.
+
+    Returns
+    -------
+    None
+        None, since input `by_bc` is modified in-place.
+
+    """
+    barcodes = list(by_bc)
+    counts = [len(by_bc[barcode]) for barcode in barcodes]
+    encoded = None
+    if len(barcodes) >= VECTORIZE_MIN_BARCODES:
+        encoded = _encode_randomers(barcodes)
+
+    # Step #1: assign ambigious randomers to non-ambiguous randomers
+    # Identify ambiguous barcodes first.
+    nonambig_bcs = []  # indexes of accepted_barcodes
+    ambig_bcs = []  # ambiguous_barcodes
+    for index, barcode in enumerate(barcodes):
+        undefined_nucleotides = barcode.count('N')
+        if undefined_nucleotides == 0:
+            nonambig_bcs.append(index)
+        else:
+            ambig_bcs.append((undefined_nucleotides, barcode, index))
+
+    # For each ambiguous randomer, identify similar non-ambiguous one.
+    # If match is found, move hits form ambiguous to the non-ambiguous one.
+    # If no match is found, declare ambiguous randomer (even if it has 'N's) as
+    # non-ambiguous.
+    for _, amb_bc, amb_index in sorted(ambig_bcs):
+        if not nonambig_bcs:
+            matches = []
+        elif encoded is None:
+            matches = [index for index in nonambig_bcs if
+                       _match(barcodes[index], amb_bc, mismatches)]
+        else:
+            others = numpy.array(nonambig_bcs)
+            matches = others[_count_mismatches(encoded, amb_index, others) <= mismatches].tolist()
+
+        if matches:
+            # Take the most frequent of matching barcodes. Frequency changes
+            # when hits are assigned from ambiguous to non-ambiguous randomer.
+            index = max(matches, key=lambda i: (counts[i], barcodes[i]))
+            by_bc[barcodes[index]].extend(by_bc.pop(amb_bc))
+            counts[index] += counts[amb_index]
+        else:
+            nonambig_bcs.append(amb_index)
+
+    if umi_method == 'directional':
+        _merge_directional(by_bc, barcodes, counts, nonambig_bcs, mismatches)
+        return
+
+    # Step #2: identify and accept randomers with strong support
+    # Randomers that are supported by a threshold number of hits are accepted as unique.
+    # Threshold is defined as the proportion (ratio_th) of the number of reads assigned
+    # to the most frequent randomer.
+    order_bcs = sorted(nonambig_bcs, key=lambda i: (counts[i], barcodes[i]), reverse=True)
+    min_hit_count = max(1, math.floor(counts[order_bcs[0]] * ratio_th))
+
+    # If number of barcodes exceeds ``max_barcodes`` parameter, just skip the last step
+    if len(by_bc) > max_barcodes:
+        return
+
+    # Step #3: merge remaining
+    # For each barcode with number of reads below the threshold, identify if there
+    # exists any similar one. If there is, join the hits form second barcode to the
+    # first one. Start with most frequent randomers first. Barcode that takes
+    # over hits only gets more frequent, so the order of barcodes that are not
+    # yet processed does not change and one pass through ``order_bcs`` is enough.
+    # Barcodes below the threshold are all at the end of ``order_bcs``:
+    first_low = next(
+        (i for i, index in enumerate(order_bcs) if counts[index] < min_hit_count), len(order_bcs))
+    low_bcs = order_bcs[first_low:]
+    is_merged = numpy.zeros(len(barcodes), dtype=bool)
+    for i, index in enumerate(order_bcs):
+        if is_merged[index]:
+            continue
+        start = max(i + 1, first_low) - first_low
+        if start >= len(low_bcs):
+            break
+
+        if encoded is None:
+            matches = [other for other in low_bcs[start:] if not is_merged[other] and
+                       _match(barcodes[index], barcodes[other], mismatches)]
+        else:
+            others = numpy.array(low_bcs[start:])
+            others = others[~is_merged[others]]
+            matches = others[_count_mismatches(encoded, index, others) <= mismatches].tolist()
+
+        for other in matches:
+            by_bc[barcodes[index]].extend(by_bc.pop(barcodes[other]))
+            is_merged[other] = True
@@ -73,360 +73,101 @@ end position of read. By default, score is of course assigned to cross-link
 location. But for diagnostic purpuses, scores can also be assigned to middle or
 end coordinate of the read.
 """
-import re
 import os
+import sys
 import math
+import queue
+import zlib
 import logging
+import functools
+import itertools
+import threading
+import multiprocessing
 
 import pybedtools
-import pysam
 from pysam import AlignmentFile  # pylint: disable=no-name-in-module
 
 import iCount
-from iCount.files import _f2s, get_temp_file_name
+from iCount.files import get_temp_file_name
+from iCount.files.bam import ensure_sorted_indexed, open_sorted
+from iCount.mapping.randomers import BARCODE_COUNTER_SIZE, _BarcodeCounter, _Hits, \
+    _get_random_barcode, _get_tag_barcode
+from iCount.mapping.xlsites_checkpoint import _Checkpoint
+from iCount.mapping.xlsites_common import _StateWriter, _quantify, _save_results, _update
 
 
 LOGGER = logging.getLogger(__name__)
-VALID_NUCLEOTIDES = set('ATCGN')
-RANDOM_BARCODE_REGEX = r'.*:rbc:([ATCGN]+).*'
-
-
-def _iter_bed_dict(bed, val_index=None):
-    """Iterate through dict object."""
-    if val_index is not None:
-        for (chrome, strand), by_pos in bed.items():
-            for pos, val in by_pos.items():
-                val = val[val_index]
-                yield pybedtools.create_interval_from_list(
-                    [chrome, pos, pos + 1, '.', _f2s(val), strand]
-                )
-    else:
-        for (chrome, strand), by_pos in bed.items():
-            for pos, val in by_pos.items():
-                yield pybedtools.create_interval_from_list(
-                    [chrome, pos, pos + 1, '.', _f2s(val), strand]
-                )
-
-
-def _save_dict(bed, out_fname, val_index=None):
-    """Save data from dict to BED file."""
-    sites = pybedtools.BedTool(
-        _iter_bed_dict(bed, val_index=val_index)
-    ).saveas()
-    sites1 = sites.sort().saveas(out_fname)
-    return sites1
-
-
-def _get_random_barcode(query_name, metrics):
-    """Extract random barcode from ``query_name``."""
-    match = re.match(RANDOM_BARCODE_REGEX, query_name)
-    if match:
-        barcode = match.group(1)
-    elif ':' in query_name:
-        barcode = query_name.rsplit(':', 1)[1]
-        if set(barcode) - VALID_NUCLEOTIDES:
-            # invalid barcode characters
-            barcode = ''
-            metrics.invalidrandomer_recs += 1
-    else:
-        barcode = ''
-        metrics.norandomer_recs += 1
-
-    return barcode
-
-
-def _match(seq1, seq2, mismatches):
-    """
-    Test if sequence seq1 and seq2 are sufficiently similar.
-
-    Parameters
-    ----------
-    seq1 : str
-        First sequence.
-    seq2 : str
-        Second sequence.
-    mismatches : int
-        Number of allowed mismatches between given sequences.
 
-    Returns
-    -------
-    bool
-        Do sequence `seq1` and `seq2` have less or equal than ``mismatches``
+#: When running in multiple processes, contigs longer than this are split in
+#: multiple chunks, which are processed independently.
+MIN_CHUNK_SIZE = 10 ** 7
+#: Complete cross-link positions are flushed each time this many records are read.
+FLUSH_INTERVAL = 10000
+#: Records are read ahead on separate thread in batches of this size. At most
+#: READ_AHEAD_BATCHES batches are waiting to be processed. If it is 0 or there
+#: is only one CPU, records are read in the processing thread.
+READ_AHEAD_BATCH_SIZE = 1000
+READ_AHEAD_BATCHES = 8
 
-    """
-    seq1, seq2 = seq1.upper(), seq2.upper()
-    matches = sum([(nuc1 == 'N' or nuc2 == 'N' or nuc1 == nuc2) for nuc1, nuc2 in zip(seq1, seq2)])
-    return max(len(seq1), len(seq2)) - matches <= mismatches
+#: Read names are hashed into integers in range [0, SAMPLE_HASH_RANGE).
+SAMPLE_HASH_RANGE = 2 ** 32
 
 
-def _update(cur_vals, to_add):
+def _load_segment_borders(segmentation):
     """
-    Add the values from ``to_add`` to appropriate place in ``cur_vals``.
-
-    Note: cur_vals is updated in place!
-
-    Parameters
-    ----------
-    to_add : dict
-        Dict with update data.
-
-    Returns
-    -------
-    None
-        None.
-
-    """
-    for pos, vals_to_add in to_add.items():
-        prev_vals = cur_vals.get(pos, [0] * len(vals_to_add))
-        cur_vals[pos] = [p + n for p, n in zip(prev_vals, vals_to_add)]
-
-
-def _merge_similar_randomers(by_bc, mismatches, max_barcodes, ratio_th=0.1):
-    """
-    Merge randomers on same site that are max ``mismatches`` different.
-
-    Input parameter `by_bc` has te following structure:
-    by_bc = {
-        'AAA': [(middle_pos, end_pos, read_len, num_mapped, second_start),  # hit1
-                (middle_pos, end_pos, read_len, num_mapped, second_start),  # hit2
-                (middle_pos, end_pos, read_len, num_mapped, second_start),  # ...
-        ]
-        'AAT': [(middle_pos, end_pos, read_len, num_mapped, second_start),  # hit1
-                (middle_pos, end_pos, read_len, num_mapped, second_start),  # hit2
-        ]
-
-    Steps in function:
-        0. Identify ambiguous randomers ('N' characters in barcode)
-
-        1. For each ambiguous randomer, identify similar non-ambiguous one. If
-        match is found, move hits form ambiguous to the non-ambiguous one. If no
-        match is found, declare ambiguous randomer (one that has 'N's) as
-        non-ambiguous anyway.
-
-        2. Identify and accept randomers with strong support.
-        Randomers that are supported by a threshold number of hits are accepted as
-        unique. Threshold is defined as the proportion (ratio_th) of the number of
-        reads assigned to the most frequent randomer.
-
-        3. Merge remaining.
-        For each barcode with number of reads below the threshold, identify if there
-        exists any similar one. If there is, join the hits form second barcode to
-        the first one.
-
-    TODO: Code should be improved in step #1. Instead of finding any match,
-    match with least difference should be found. Check also the skipped unit
-    test in tests/test_xlsites.py
-
-    Parameters
-    ----------
-    by_bc : dict
-        Dictionary of barcodes and their hits.
-    mismatches : int
-        Reads on same position with random barcode differing less than
-        ``mismatches`` are grouped together.
-
-    Returns
-    -------
-    None
-        None, since input `by_bc` is modified in-place.
-
-    """
-    # Step #1: assign ambigious randomers to non-ambiguous randomers
-    # Identify ambiguous barcodes first.
-    nonambig_bcs = set()  # accepted_barcodes
-    ambig_bcs = []  # ambiguous_barcodes
-    for barcode in by_bc.keys():
-        undefined_nucleotides = barcode.count('N')
-        if undefined_nucleotides == 0:
-            nonambig_bcs.add(barcode)
-        else:
-            ambig_bcs.append((undefined_nucleotides, barcode))
-
-    # For each ambiguous randomer, identify similar non-ambiguous one.
-    # If match is found, move hits form ambiguous to the non-ambiguous one.
-    # If no match is found, declare ambiguous randomer (even if it has 'N's) as
-    # non-ambiguous.
-    for _, amb_bc in sorted(ambig_bcs):
-        matches = False
-        # Get list of accepted barcodes (sorted by decreasing frequency).
-        # Sort is required each time as frequency changes when hits are
-        # assigned from ambiguous to non-ambiguous randomer
-        order_bcs = sorted([(len(hits), bc) for bc, hits in by_bc.items() if
-                            bc in nonambig_bcs], reverse=True)
-
-        for _, barcode in order_bcs:
-            if _match(barcode, amb_bc, mismatches):
-                matches = True
-                by_bc[barcode].extend(by_bc.pop(amb_bc))
-                break
-        if not matches:
-            nonambig_bcs.add(amb_bc)
-
-    # Step #2: identify and accept randomers with strong support
-    # Randomers that are supported by a threshold number of hits are accepted as unique.
-    # Threshold is defined as the proportion (ratio_th) of the number of reads assigned
-    # to the most frequent randomer.
-    order_bcs = [(len(hits), bc) for bc, hits in by_bc.items()]
-    order_bcs = sorted(order_bcs, reverse=True)
-    min_hit_count = max(1, math.floor(order_bcs[0][0] * ratio_th))
-
-    # If number of barcodes exceeds ``max_barcodes`` parameter, just skip the last step
-    if len(by_bc) > max_barcodes:
-        return
-
-    # Step #3: merge remaining
-    # For each barcode with number of reads below the threshold, identify if there
-    # exists any similar one. If there is, join the hits form second barcode to the
-    # first one.
-    merged = True
-    while merged:
-        # start with most frequent randomers first
-        order_bcs = [(len(hits), bc) for bc, hits in by_bc.items()]
-        order_bcs = sorted(order_bcs, reverse=True)
-        merged = False
-        for i, (_, barcode) in enumerate(order_bcs):
-            for nhits2, barcode2 in order_bcs[i + 1:]:
-                if nhits2 >= min_hit_count:
-                    # do not try to merge barcodes with large support
-                    continue
-                if _match(barcode, barcode2, mismatches):
-                    merged = True
-                    by_bc[barcode].extend(by_bc.pop(barcode2))
-            if merged:
-                break
-
-
-def _collapse(xlink_pos, by_bc, group_by, multimax=1):
-    """
-    Report number of cDNAs and reads in cross-link site on xlink_pos.
-
-    Input parameter `by_bc` has te following structure:
-    by_bc = {
-        'AAA': [(middle_pos, end_pos, read_len, num_mapped, cigar, second_start),  # hit1
-                (middle_pos, end_pos, read_len, num_mapped, cigar, second_start),  # hit2
-                (middle_pos, end_pos, read_len, num_mapped, cigar, second_start),  # ...
-        ]
-        'AAT': [(middle_pos, end_pos, read_len, num_mapped, cigar, second_start),  # hit1
-                (middle_pos, end_pos, read_len, num_mapped, cigar, second_start),  # hit2
-                ]
-
-    Counting the number of reads is easy - just count the number of hits per
-    cross-link site.
-
-    Counting the number of cDNAs is also easy - just count the number of
-    different barcodes. However, following scenarions also need to be handled:
-
-        * one read ban be mapped to multiple sites. In this case, the
-          "contribution" of such read has to be divided equally to all positions
-          that it maps to.
-        * Also, longer reads should have proportionally greater "contribution".
-          than the short ones.
-
-    Upper two scenarions imply that each read contributes::
-
-        weight = 1 * 1/a * b/c
-        # a = number of hits
-        # b = read length
-        # c = sum(read lengths per same barcode)
-
-    Another factor to take into account is also the possibility that a group of
-    reads with equal start position and barcode represents multiple cross-links.
-    Imagine a read starting 10 bp before exon-intron junction. One group of
-    reads maps in the intron section and other reads skip the intron and map on
-    next exon with the second part of the read. This can be solved by grouping
-    by "second_start", which is the coordinate of the first nucleotide of the
-    second part of the read. Each group with unique second start is treated as
-    an independent cross-link event. This is done in function
-    ``_separate_by_second_starts``
-
-    Returns an object ``counts``::
-
-        counts = {
-            position: [cDNA_count, reads_count],
-            123: [3.14, 42],
-            124: [5.79, 16],
+    Index segment borders on all chromosomes in a single pass through ``segmentation``.
+
+    Second-start of a split read is expected on segment borders. Returned dict
+    has, for each chromosome in ``segmentation`` file, a set of segment start
+    coordinates for reads on "+" strand and a set of segment stop coordinates
+    for reads on "-" strand::
+
+        borders = {
+            '1': {
+                '+': {100, 250, ...},
+                '-': {99, 420, ...},
+            },
             ...
         }
 
-    Parameters
-    ----------
-    xlink_pos : int
-        Cross link position (genomic coordinate).
-    by_bc : dict
-        Dict with hits for each barcode.
-    group_by : str
-        Report by start, middle or end position.
-    multimax : int
-        Ignore reads, mapped to more than ``multimax`` places.
-
-    Returns
-    -------
-    dict
-        Number of cDNA and reads for each position.
-
     """
-    group_by_index = ['start', 'middle', 'end'].index(group_by)
-
-    # Container for cDNA and read counts:
-    counts = {}
-
-    for hits in by_bc.values():
-
-        # separate in groups by second-start
-        ss_groups = {}
-        for read in hits:
-            ss_groups.setdefault(read[4], []).append(read)
-
-        for ss_group in ss_groups.values():
-
-            # Sum of all read lengths per ss_group:
-            sum_len_per_barcode = sum([i[2] for i in ss_group if i[3] <= multimax])
-
-            for middle_pos, end_pos, read_len, num_mapped, _ in ss_group:
-                if num_mapped > multimax:
-                    continue
-                grp_pos = (xlink_pos, middle_pos, end_pos)[group_by_index]
-                weight = read_len / (num_mapped * sum_len_per_barcode)
-
-                current_values = counts.get(grp_pos, (0, 0))
-                upadated_values = (current_values[0] + weight, current_values[1] + 1)
-                counts[grp_pos] = upadated_values
-
-    return counts
+    borders = {}
+    for segment in pybedtools.BedTool(segmentation):
+        chrom_borders = borders.setdefault(segment.chrom, {'+': set(), '-': set()})
+        if segment[2] != 'gene':
+            chrom_borders['+'].add(segment.start)
+            chrom_borders['-'].add(segment.stop)
+    return borders
 
 
 def _intersects_with_annotaton(second_start, segmentation, chrom, strand):
     """
     Test if second_start corresopnds to any entry in segmentation.
 
+    Parameter ``segmentation`` are segment borders on chromosome of the read,
+    as returned by ``_load_segment_borders``.
+
     Returns
     -------
         bool
     Does the read's second_start corresopnd to any known segment in segmentation
 
     """
-    for gene_content in segmentation.values():
-        for transcript_id, transcript_content in gene_content.items():
-            if transcript_id == 'gene_segment':
-                continue
-            for segment in transcript_content:
-                if strand == '+':
-                    if second_start == segment.start:
-                        return True
-                else:
-                    if second_start == segment.stop:
-                        return True
-    return False
+    return second_start in segmentation[strand]
 
 
-def _second_start(read, poss, strand, chrom, segmentation, holesize_th):
+def _second_start(read, blocks, strand, chrom, segmentation, holesize_th):
     """
     Return the coordinate of second start.
 
     If read is not split or we wish algorithm
     to think of read as linear, second_start equals to 0.
+
+    Parameter ``blocks`` are aligned blocks of read, as returned by
+    ``read.get_blocks()``. Parameter ``segmentation`` are segment borders on
+    chromosome of the read, as returned by ``_load_segment_borders``.
     """
-    holes = [j - i - 1 for i, j in zip(poss, poss[1:])]
+    holes = [start - end for (_, end), (start, _) in zip(blocks, blocks[1:])]
     # Get the size of the biggest hole:
     biggest_hole_size = max(holes) if holes else 0
 
@@ -438,49 +179,72 @@ def _second_start(read, poss, strand, chrom, segmentation, holesize_th):
             # Still, read is not treated as on with distinct second_start.
             # However, it is reported as starnge:
             is_strange = True
+    elif biggest_hole_size == 0:
+        # Read is contiguous, take the hole between first two nucleotides:
+        second_start = blocks[0][0] + 1 if strand == '+' else blocks[0][0]
     else:
         biggest_hole_size_index = holes.index(biggest_hole_size)
         # Take right border of hole on "+" and left border on "-" strand:
         if strand == '+':
-            second_start = poss[biggest_hole_size_index + 1]
+            second_start = blocks[biggest_hole_size_index + 1][0]
         else:
-            second_start = poss[biggest_hole_size_index]
+            second_start = blocks[biggest_hole_size_index][1] - 1
 
         # Read is strange if:
         # it is not intersecting with segmentation AND
         # if there actually is a hole
-        if not _intersects_with_annotaton(second_start, segmentation, chrom, strand) and \
-                biggest_hole_size != 0:
+        if not _intersects_with_annotaton(second_start, segmentation, chrom, strand):
             is_strange = True
 
     return second_start, is_strange
 
 
-def _get_read_data(read, metrics, mapq_th, segmentation=None, gap_th=4):
+def _get_aligned_position(blocks, index):
+    """
+    Return ``index``-th reference position covered by aligned ``blocks``.
+
+    Negative ``index`` counts from the end, the same as when indexing list
+    returned by ``read.get_reference_positions()``.
+    """
+    if index < 0:
+        index += sum(end - start for start, end in blocks)
+    if index >= 0:
+        for start, end in blocks:
+            if index < end - start:
+                return start + index
+            index -= end - start
+    raise IndexError('Index of aligned position out of range.')
+
+
+def _get_read_data(read, metrics, mapq_th, segmentation=None, gap_th=4, barcode_tag=None):
     """Extract neccessary data from read."""
     # NH (number of reported alignments) tag is required:
     if not read.has_tag('NH'):
         raise ValueError('"NH" tag not set for record: {}'.format(read.query_name))
     num_mapped = read.get_tag('NH')
 
-    # Extract randomer sequence (barcode) from querry name (= read name)
-    barcode = _get_random_barcode(read.query_name, metrics)
-    metrics.bc_cn[barcode] = metrics.bc_cn.get(barcode, 0) + 1
+    # Extract randomer sequence (barcode) from tag or from querry name (= read name)
+    if barcode_tag:
+        barcode = _get_tag_barcode(read, barcode_tag, metrics)
+    else:
+        barcode = _get_random_barcode(read.query_name, metrics)
+    metrics.bc_cn.add(barcode)
 
     # position of cross-link is one nucleotide before start of read
-    poss = read.get_reference_positions()
+    blocks = read.get_blocks()
+    first_pos, last_pos = blocks[0][0], blocks[-1][1] - 1
     if read.is_reverse:
         strand = '-'
-        xlink_pos = poss[-1] + 1
-        end_pos = poss[0]
+        xlink_pos = last_pos + 1
+        end_pos = first_pos
     else:
         strand = '+'
-        xlink_pos = poss[0] - 1
+        xlink_pos = first_pos - 1
         xlink_pos = 1 if xlink_pos < 1 else xlink_pos  # Case of neg. pos on circular MT
-        end_pos = poss[-1]
+        end_pos = last_pos
 
     chrom = read.reference_name
-    second_start, is_strange = _second_start(read, poss, strand, chrom, segmentation, gap_th)
+    second_start, is_strange = _second_start(read, blocks, strand, chrom, segmentation, gap_th)
     if is_strange:
         metrics.strange_recs += 1
 
@@ -489,26 +253,266 @@ def _get_read_data(read, metrics, mapq_th, segmentation=None, gap_th=4):
     # of center in case length is even, happens by default on + strand
     idx = read.query_length // 2 - 1 if (strand == '-' and read.query_length % 2 == 0) \
         else read.query_length // 2
-    middle_pos = poss[idx]
+    middle_pos = _get_aligned_position(blocks, idx)
 
     return (xlink_pos, barcode, is_strange, strand, middle_pos, end_pos, read.query_length,
             num_mapped, second_start)
 
 
-def _processs_bam_file(bam_fname, metrics, mapq_th, skipped, segmentation=None, gap_th=1000000):
+def _get_record_position(read):
+    """
+    Return position by which record is assigned to a genome chunk.
+
+    Mapped records are assigned by their cross-link position, so that all hits
+    on the same cross-link site end up in the same chunk.
+    """
+    if read.is_unmapped:
+        return read.reference_start
+    if read.is_reverse:
+        return read.get_blocks()[-1][1]
+    return max(1, read.get_blocks()[0][0] - 1)
+
+
+def _get_sample_threshold(sample_fraction):
+    """
+    Return threshold on read name hash for keeping ``sample_fraction`` of reads.
+
+    Read is kept if CRC32 checksum of its name is below threshold. Return None
+    if all reads are kept.
+    """
+    if sample_fraction >= 1:
+        return None
+    return int(sample_fraction * SAMPLE_HASH_RANGE)
+
+
+def _init_metrics(metrics, barcode_counter_size=BARCODE_COUNTER_SIZE):
+    """Set counters, that are computed when processing BAM file, to initial values."""
+    metrics.all_recs = 0  # All records
+    metrics.unsampled_recs = 0  # Records not in sample (when subsampling)
+    metrics.notmapped_recs = 0  # Not mapped records
+    metrics.mapped_recs = 0  # Mapped records
+    metrics.lowmapq_recs = 0  # Records with insufficient quality
+    metrics.used_recs = 0  # Records used in analysis (all - unmapped - lowmapq)
+    metrics.invalidrandomer_recs = 0  # Records with invalid randomer
+    metrics.norandomer_recs = 0  # Records with no randomer
+    metrics.bc_cn = _BarcodeCounter(barcode_counter_size)  # Barcode counter
+    metrics.strange_recs = 0  # Strange records (not expected by segmentation)
+
+
+def _merge_metrics(metrics, to_add):
+    """Add counters from ``to_add`` to ``metrics``."""
+    for name, value in vars(to_add).items():
+        if name == 'context':
+            continue
+        if isinstance(value, _BarcodeCounter):
+            getattr(metrics, name).merge(value)
+        elif isinstance(value, dict):
+            counter = getattr(metrics, name)
+            for key, count in value.items():
+                counter[key] = counter.get(key, 0) + count
+        else:
+            setattr(metrics, name, getattr(metrics, name) + value)
+
+
+def _report_metrics(metrics, skipped):
+    """Log counters, that were computed when processing BAM file."""
+    LOGGER.info('All records in BAM file: %d', metrics.all_recs)
+    if metrics.unsampled_recs:
+        LOGGER.info('Records not in sample: %d', metrics.unsampled_recs)
+    LOGGER.info('Reads not mapped: %d', metrics.notmapped_recs)
+    LOGGER.info('Mapped reads records (hits): %d', metrics.mapped_recs)
+    LOGGER.info('Hits ignored because of low MAPQ: %d', metrics.lowmapq_recs)
+    LOGGER.info('Records used for quantification: %d', metrics.used_recs)
+    LOGGER.info('Records with invalid randomer info in header: %d', metrics.invalidrandomer_recs)
+    LOGGER.info('Records with no randomer info: %d', metrics.norandomer_recs)
+    LOGGER.info('Ten most frequent randomers:')
+    for count, barcode in metrics.bc_cn.most_common(10):
+        LOGGER.info('    %s: %d', barcode, count)
+    LOGGER.info('There are %d reads with second-start not falling on segmentation. They are '
+                'reported in file: %s', metrics.strange_recs, skipped)
+
+
+def _read_ahead(records, batch_size=READ_AHEAD_BATCH_SIZE, max_batches=READ_AHEAD_BATCHES):
+    """
+    Iterate over ``records``, that are read in batches on a separate thread.
+
+    Pysam releases GIL while htslib reads and decodes records, so reading of
+    next batches overlaps with processing of current batch in calling thread.
+    Bounded queue of batches stops reading when processing falls behind.
+    Exception raised when reading is re-raised in calling thread.
+    """
+    batches = queue.Queue(max_batches)
+    stop = threading.Event()
+
+    def put(item):
+        """Put ``item`` in queue, unless iteration is stopped."""
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        """Put batches of records in queue, ending with an empty batch."""
+        try:
+            iterator = iter(records)
+            batch = True
+            while batch and not stop.is_set():
+                batch = list(itertools.islice(iterator, batch_size))
+                put(batch)
+        except Exception as error:  # pylint: disable=broad-except
+            put(error)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            batch = batches.get()
+            if isinstance(batch, Exception):
+                raise batch
+            if not batch:
+                return
+            for record in batch:
+                yield record
+    finally:
+        # Also if iteration is abandoned, reader must be done before file is closed.
+        stop.set()
+        producer.join()
+
+
+def _open_skipped(fname, header, threads=1, reference=None):
+    """Open BAM file (or CRAM file, if ``fname`` ends with .cram) for writing skipped records."""
+    mode = 'wc' if fname.endswith('.cram') else 'wb'
+    return AlignmentFile(fname, mode, header=header, threads=threads, reference_filename=reference)
+
+
+def _fetch_hits(bamfile, chrom, metrics, mapq_th, strange_bam, segmentation=None, gap_th=1000000,
+                start=None, stop=None, barcode_tag=None, sample_fraction=1.0):
+    """
+    Group hits on chromosome ``chrom`` by strand, cross-link position and barcode.
+
+    If ``start`` or ``stop`` are given, only records with position (as
+    determined by ``_get_record_position``) in interval [start, stop) are
+    processed.
+
+    If ``sample_fraction`` is below 1, only records of reads with name hash
+    below threshold from ``_get_sample_threshold`` are used. Hash depends only
+    on read name, so all hits of multimapped read are kept or dropped together
+    and the same reads are kept in every run.
+
+    Records are coordinate sorted, so no later record can have cross-link
+    position smaller than one nucleotide before the start of current record.
+    Hits on such positions are complete and are yielded every
+    ``FLUSH_INTERVAL`` records. Memory usage is therefore proportional to the
+    local read depth and not to the chromosome size. If there are multiple
+    CPUs, records are read ahead on separate thread with ``_read_ahead``.
+
+    Yields
+    ------
+    tuple
+        Strand, position below which all cross-link positions are complete and
+        hits on this positions, grouped by cross-link position and barcode.
+
+    """
+    def finalize(reads_pending_fwd, reads_pending_rev, start):
+        """Yield appropriate data."""
+        reads_to_process_fwd = {}
+        for pos in list(reads_pending_fwd):
+            if pos < start:
+                reads_to_process_fwd[pos] = reads_pending_fwd.pop(pos)
+        if reads_to_process_fwd:
+            yield ('+', start, reads_to_process_fwd)
+
+        reads_to_process_rev = {}
+        for pos in list(reads_pending_rev):
+            if pos < start:
+                reads_to_process_rev[pos] = reads_pending_rev.pop(pos)
+        if reads_to_process_rev:
+            yield ('-', start, reads_to_process_rev)
+
+    chunked = start is not None or stop is not None
+    if chunked:
+        # Records are assigned to chunks by cross-link position, which can be
+        # one nucleotide outside of the region covered by the read.
+        records = bamfile.fetch(
+            chrom, None if start is None else max(start - 1, 0), None if stop is None else stop + 1)
+    else:
+        records = bamfile.fetch(chrom)
+    if READ_AHEAD_BATCHES and (os.cpu_count() or 1) > 1:
+        records = _read_ahead(records, READ_AHEAD_BATCH_SIZE, READ_AHEAD_BATCHES)
+
+    sample_threshold = _get_sample_threshold(sample_fraction)
+    reads_pending_fwd = {}
+    reads_pending_rev = {}
+    read = None
+    for records_read, read in enumerate(records, start=1):
+        if records_read % FLUSH_INTERVAL == 0:
+            for data in finalize(reads_pending_fwd, reads_pending_rev, read.reference_start - 1):
+                yield data
+
+        if chunked:
+            position = _get_record_position(read)
+            if (start is not None and position < start) or (stop is not None and position >= stop):
+                continue
+
+        metrics.all_recs += 1
+        if sample_threshold is not None and \
+                zlib.crc32(read.query_name.encode()) >= sample_threshold:
+            metrics.unsampled_recs += 1
+            continue
+        if read.is_unmapped:
+            metrics.notmapped_recs += 1
+            continue
+        metrics.mapped_recs += 1
+        if read.mapping_quality < mapq_th:
+            metrics.lowmapq_recs += 1
+            continue
+        metrics.used_recs += 1
+
+        rdata = _get_read_data(
+            read, metrics, mapq_th, segmentation=segmentation, gap_th=gap_th,
+            barcode_tag=barcode_tag)
+        (xlink_pos, barcode, is_strange, strand), read_data = rdata[0:4], rdata[4:]
+
+        if is_strange:
+            strange_bam.write(read)
+        else:
+            reads_pending = reads_pending_fwd if strand == '+' else reads_pending_rev
+            by_bc = reads_pending.setdefault(xlink_pos, {})
+            if barcode not in by_bc:
+                # Same barcode is a key on many positions, so store one copy of it.
+                by_bc[sys.intern(barcode)] = _Hits()
+            by_bc[barcode].append(read_data)
+
+    # Sliding window start (smaller coordinate)
+    window_start = 0 if read is None else (0 if not read.positions else read.positions[0])
+    for data in finalize(reads_pending_fwd, reads_pending_rev, window_start):
+        yield data
+
+    chrom_len = bamfile.get_reference_length(chrom)
+    for data in finalize(reads_pending_fwd, reads_pending_rev, chrom_len):
+        yield data
+
+
+def _processs_bam_file(bam_fname, metrics, mapq_th, skipped, segmentation=None, gap_th=1000000,
+                       sort_memory='768M', threads=1, barcode_tag=None,
+                       barcode_counter_size=BARCODE_COUNTER_SIZE, reference=None,
+                       sample_fraction=1.0):
     """
     Extract data from BAM file into chunks of genome.
 
     Parameters
     ----------
     bam_fname : str
-        BAM file with mapped reads.
+        BAM or CRAM file with mapped reads.
     metrics : iCount.Metrics
         Metrics object for storing analysis metadata.
     mapq_th : int
         Ignore hits with MAPQ < mapq_th.
     skipped : str
-        Output BAM file to store reads that do not map as expected by segmentation and
+        Output BAM (or CRAM, if name ends with .cram) file to store reads that
+        do not map as expected by segmentation and
         reference genome sequence. If read's second start does not fall on any of
         segmentation borders, it is considered problematic. If segmentation is not provided,
         every read in two parts with gap longer than gap_th is not used (skipped).
@@ -517,6 +521,20 @@ def _processs_bam_file(bam_fname, metrics, mapq_th, skipped, segmentation=None,
         File with segmentation (obtained by ``iCount segment``).
     gap_th : int
         Reads with gaps less than gap_th are treated as if they have no gap.
+    sort_memory : str
+        Maximum memory per thread used when input needs to be sorted.
+    threads : int
+        Number of threads used for BAM compression and decompression and
+        when input needs to be sorted.
+    barcode_tag : str
+        Read randomers from this tag instead of from read names.
+    barcode_counter_size : int
+        Number of randomers tracked when counting the most frequent
+        randomers. If 0, all randomers are counted exactly.
+    reference : str
+        FASTA file with reference genome, needed for CRAM input or output.
+    sample_fraction : float
+        Fraction of reads used, selected deterministically by read name.
 
     Returns
     -------
@@ -526,114 +544,268 @@ def _processs_bam_file(bam_fname, metrics, mapq_th, skipped, segmentation=None,
         BAM file with
 
     """
-    metrics.all_recs = 0  # All records
-    metrics.notmapped_recs = 0  # Not mapped records
-    metrics.mapped_recs = 0  # Mapped records
-    metrics.lowmapq_recs = 0  # Records with insufficient quality
-    metrics.used_recs = 0  # Records used in analysis (all - unmapped - lowmapq)
-    metrics.invalidrandomer_recs = 0  # Records with invalid randomer
-    metrics.norandomer_recs = 0  # Records with no randomer
-    metrics.bc_cn = {}  # Barcode counter
-    metrics.strange_recs = 0  # Strange records (not expected by segmentation)
-
-    def finalize(reads_pending_fwd, reads_pending_rev, start, chrom, progress):
-        """Yield appropriate data."""
-        reads_to_process_fwd = {}
-        for pos in list(reads_pending_fwd):
-            if pos < start:
-                reads_to_process_fwd[pos] = reads_pending_fwd.pop(pos)
-        if reads_to_process_fwd:
-            yield ((chrom, '+'), progress, reads_to_process_fwd)
-
-        reads_to_process_rev = {}
-        for pos in list(reads_pending_rev):
-            if pos < start:
-                reads_to_process_rev[pos] = reads_pending_rev.pop(pos)
-        if reads_to_process_rev:
-            yield ((chrom, '-'), progress, reads_to_process_rev)
+    _init_metrics(metrics, barcode_counter_size=barcode_counter_size)
 
     # Ensure sorted and and indexed input BAM file:
-    LOGGER.info('Ensuring that bam file is sorted and indexed...')
-    tmp_file = get_temp_file_name()
-    pysam.sort('-o', tmp_file, bam_fname)  # pylint: disable=no-member
-    pysam.index(tmp_file)  # pylint: disable=no-member
+    bam_sorted, index, tmp_files = ensure_sorted_indexed(
+        bam_fname, sort_memory=sort_memory, threads=threads, reference=reference)
     genome_done = 0
     ann_data = None
+    borders = _load_segment_borders(segmentation) if segmentation else {}
     LOGGER.info('Detecting cross-links...')
-    with AlignmentFile(tmp_file, 'rb') as bamfile:
-        strange_bam = AlignmentFile(skipped, 'wb', header=bamfile.header)
+    with open_sorted(bam_sorted, index, threads=threads, reference=reference) as bamfile, \
+            _open_skipped(skipped, bamfile.header, threads=threads, reference=reference) as strange_bam:
         genome_size = sum([contig['LN'] for contig in bamfile.header['SQ']])
         for chrom in bamfile.references:
             chrom_len = bamfile.header['SQ'][bamfile.get_tid(chrom)]['LN']
             if segmentation:
-                # pylint: disable=protected-access
-                ann_data = iCount.genomes.segment._prepare_segmentation(segmentation, chrom)
-
-            reads_pending_fwd = {}
-            reads_pending_rev = {}
-            read = None
-            for read in bamfile.fetch(chrom):
-                metrics.all_recs += 1
-                if read.is_unmapped:
-                    metrics.notmapped_recs += 1
-                    continue
-                metrics.mapped_recs += 1
-                if read.mapping_quality < mapq_th:
-                    metrics.lowmapq_recs += 1
-                    continue
-                metrics.used_recs += 1
-
-                rdata = _get_read_data(
-                    read, metrics, mapq_th, segmentation=ann_data, gap_th=gap_th)
-                (xlink_pos, barcode, is_strange, strand), read_data = rdata[0:4], rdata[4:]
-
-                if is_strange:
-                    strange_bam.write(read)
-                else:
-                    if strand == '+':
-                        reads_pending_fwd.setdefault(
-                            xlink_pos, {}).setdefault(barcode, []).append(read_data)
-                    else:
-                        reads_pending_rev.setdefault(
-                            xlink_pos, {}).setdefault(barcode, []).append(read_data)
-
-            # Sliding window start (smaller coordinate)
-            start = 0 if read is None else (0 if not read.positions else read.positions[0])
-            progress = round(min((genome_done + start) / genome_size, 1.0), 4)
-
-            for data in finalize(reads_pending_fwd, reads_pending_rev, start, chrom, progress):
-                yield data
+                ann_data = borders.get(chrom, {})
 
-            start = chrom_len
-            progress = round(min((genome_done + start) / genome_size, 1.0), 4)
-            for data in finalize(reads_pending_fwd, reads_pending_rev, start, chrom, progress):
-                yield data
+            for strand, start, by_pos in _fetch_hits(
+                    bamfile, chrom, metrics, mapq_th, strange_bam, segmentation=ann_data,
+                    gap_th=gap_th, barcode_tag=barcode_tag, sample_fraction=sample_fraction):
+                progress = round(min((genome_done + start) / genome_size, 1.0), 4)
+                yield ((chrom, strand), progress, by_pos)
 
             genome_done += chrom_len
 
     # Clean up:
-    os.remove(tmp_file)
+    for tmp_file in tmp_files:
+        os.remove(tmp_file)
 
     # Report:
-    LOGGER.info('All records in BAM file: %d', metrics.all_recs)
-    LOGGER.info('Reads not mapped: %d', metrics.notmapped_recs)
-    LOGGER.info('Mapped reads records (hits): %d', metrics.mapped_recs)
-    LOGGER.info('Hits ignored because of low MAPQ: %d', metrics.lowmapq_recs)
-    LOGGER.info('Records used for quantification: %d', metrics.used_recs)
-    LOGGER.info('Records with invalid randomer info in header: %d', metrics.invalidrandomer_recs)
-    LOGGER.info('Records with no randomer info: %d', metrics.norandomer_recs)
-    LOGGER.info('Ten most frequent randomers:')
-    top10 = sorted(
-        [(count, barcode) for barcode, count in metrics.bc_cn.items()], reverse=True)[:10]
-    for count, barcode in top10:
-        LOGGER.info('    %s: %d', barcode, count)
-    LOGGER.info('There are %d reads with second-start not falling on segmentation. They are '
-                'reported in file: %s', metrics.strange_recs, skipped)
+    _report_metrics(metrics, skipped)
+
+
+def _get_regions(bamfile, processes):
+    """
+    Split genome into regions that can be processed independently.
+
+    Each region is a tuple (chrom, start, stop). Contigs longer than
+    ``MIN_CHUNK_SIZE`` can be split in multiple regions, so that work is
+    balanced among ``processes``. Start of the first and stop of the last
+    region in contig are ``None``.
+    """
+    genome_size = sum(bamfile.lengths)
+    chunk_size = max(MIN_CHUNK_SIZE, math.ceil(genome_size / (processes * 4)))
+
+    regions = []
+    for chrom, chrom_len in zip(bamfile.references, bamfile.lengths):
+        chunks = math.ceil(chrom_len / chunk_size)
+        borders = [i * chrom_len // chunks for i in range(1, chunks)]
+        for start, stop in zip([None] + borders, borders + [None]):
+            regions.append((chrom, start, stop))
+    return regions
+
+
+def _get_target_regions(bamfile, regions):
+    """
+    Read target intervals from BED or GTF file ``regions``.
+
+    Intervals are merged and returned as regions (chrom, start, stop) in
+    order of contigs in ``bamfile``. Strand of intervals is ignored. Intervals
+    on contigs that are not in ``bamfile`` are skipped.
+    """
+    intervals = {}
+    for interval in pybedtools.BedTool(regions):
+        intervals.setdefault(interval.chrom, []).append((interval.start, interval.stop))
+
+    targets = []
+    for chrom in bamfile.references:
+        merged = []
+        for start, stop in sorted(intervals.pop(chrom, [])):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        targets.extend((chrom, start, stop) for start, stop in merged)
+
+    if intervals:
+        LOGGER.warning('Skipping target intervals on contigs not in BAM file: %s',
+                       ', '.join(sorted(intervals)))
+    return targets
+
+
+def _process_region(task, mapq_th, gap_th, barcode_tag, barcode_counter_size, group_by, mismatches,
+                    multimax, ratio_th, max_barcodes, threads=1, reference=None,
+                    sample_fraction=1.0, umi_method='ratio'):
+    """
+    Detect and quantify cross-links in single region of genome.
+
+    This function is executed in worker processes. Parameter ``task`` is a
+    tuple of sorted BAM file, its index, region (as returned by
+    ``_get_regions``) and segment borders on region's chromosome (or None if
+    segmentation is not used). Records that do not map as expected are stored
+    in temporary BAM file, that is merged in final output by the main process.
+    Input BAM file is decompressed and temporary BAM file is compressed with
+    ``threads`` threads. FASTA file
+    ``reference`` is needed to decode CRAM input. Only ``sample_fraction`` of
+    reads is used, as in ``_fetch_hits``.
+
+    Returns
+    -------
+    tuple
+        Counts from single mapped reads, counts from multimapped reads,
+        metrics and name of BAM file with skipped records.
+
+    """
+    bam_fname, index, (chrom, start, stop), ann_data = task
+    metrics = iCount.Metrics()
+    _init_metrics(metrics, barcode_counter_size=barcode_counter_size)
+    single, multi = {}, {}
+
+    skipped = get_temp_file_name(extension='bam')
+    with open_sorted(bam_fname, index, threads=threads, reference=reference) as bamfile, \
+            AlignmentFile(skipped, 'wb', header=bamfile.header, threads=threads) as strange_bam:
+        for strand, _, by_pos in _fetch_hits(bamfile, chrom, metrics, mapq_th, strange_bam,
+                                             segmentation=ann_data, gap_th=gap_th,
+                                             start=start, stop=stop, barcode_tag=barcode_tag,
+                                             sample_fraction=sample_fraction):
+            _quantify(by_pos, single.setdefault((chrom, strand), {}),
+                      multi.setdefault((chrom, strand), {}), group_by, mismatches, multimax,
+                      ratio_th, max_barcodes, umi_method=umi_method)
+
+    return single, multi, metrics, skipped
+
+
+def _get_region_tasks(bam_fname, index, processes, borders=None, regions=None):
+    """
+    Split sorted BAM file into tasks for ``_process_region``.
+
+    If BED or GTF file ``regions`` is given, there is one task for each
+    (merged) target interval in it.
+
+    Returns
+    -------
+    list
+        Tasks for ``_process_region``.
+    list
+        Size of region in each task.
+
+    """
+    with AlignmentFile(bam_fname, 'rb', index_filename=index) as bamfile:
+        if regions:
+            regions = _get_target_regions(bamfile, regions)
+        else:
+            regions = _get_regions(bamfile, processes)
+        region_sizes = [
+            (stop or bamfile.get_reference_length(chrom)) - (start or 0)
+            for chrom, start, stop in regions]
+
+    tasks = [(bam_fname, index, region, None if borders is None else borders.get(region[0], {}))
+             for region in regions]
+    return tasks, region_sizes
+
+
+def _add_region_result(result, single, multi, metrics, strange_bam, remove_skipped=True):
+    """Add counts, metrics and skipped records from result of ``_process_region``."""
+    region_single, region_multi, region_metrics, region_skipped = result
+    for chrom_strand, by_pos in region_single.items():
+        _update(single.setdefault(chrom_strand, {}), by_pos)
+    for chrom_strand, by_pos in region_multi.items():
+        _update(multi.setdefault(chrom_strand, {}), by_pos)
+    _merge_metrics(metrics, region_metrics)
+
+    with AlignmentFile(region_skipped, 'rb') as region_bam:
+        for read in region_bam.fetch(until_eof=True):
+            strange_bam.write(read)
+    if remove_skipped:
+        os.remove(region_skipped)
+
+
+def _merge_region_results(results, skipped, header, barcode_counter_size=BARCODE_COUNTER_SIZE,
+                          threads=1):
+    """
+    Merge ``results`` of ``_process_region`` into counts and metrics.
+
+    Skipped records are written to BAM file ``skipped`` with ``header``,
+    compressed with ``threads`` threads.
+    """
+    single, multi = {}, {}
+    metrics = iCount.Metrics()
+    _init_metrics(metrics, barcode_counter_size=barcode_counter_size)
+    with AlignmentFile(skipped, 'wb', header=header, threads=threads) as strange_bam:
+        for result in results:
+            _add_region_result(result, single, multi, metrics, strange_bam)
+    return single, multi, metrics
+
+
+def _processs_bam_file_parallel(bam_fname, metrics, mapq_th, skipped, single, multi, processes,
+                                segmentation=None, gap_th=1000000, report_progress=False,
+                                sort_memory='768M', threads=1, barcode_tag=None,
+                                barcode_counter_size=BARCODE_COUNTER_SIZE, checkpoint=None,
+                                regions=None, reference=None, sample_fraction=1.0,
+                                **quantify_params):
+    """
+    Detect and quantify cross-links in BAM file with a pool of ``processes`` workers.
+
+    Genome is split into regions by ``_get_regions``. Counts from each region
+    are added to ``single`` and ``multi`` and counters to ``metrics`` in order
+    of regions, so results are the same as when data is processed serially.
+    If BED or GTF file ``regions`` is given, only target intervals in it are
+    processed. Only ``sample_fraction`` of reads is used, as in ``_fetch_hits``.
+
+    If ``checkpoint`` is given, results of each chromosome are first stored in
+    its shards. Chromosomes that are already stored in ``checkpoint`` are not
+    processed again, their results are read from shards.
+    """
+    _init_metrics(metrics, barcode_counter_size=barcode_counter_size)
+
+    bam_sorted, index, tmp_files = ensure_sorted_indexed(
+        bam_fname, sort_memory=sort_memory, threads=threads, reference=reference)
+    borders = _load_segment_borders(segmentation) if segmentation else None
+    tasks, region_sizes = _get_region_tasks(
+        bam_sorted, index, processes, borders=borders, regions=regions)
+    genome_size = sum(region_sizes)
+    with AlignmentFile(bam_sorted, 'rb', index_filename=index) as bamfile:
+        header = bamfile.header
+
+    LOGGER.info('Detecting cross-links in %d regions with %d processes...', len(tasks),
+                processes)
+    worker = functools.partial(
+        _process_region, mapq_th=mapq_th, gap_th=gap_th, barcode_tag=barcode_tag,
+        barcode_counter_size=barcode_counter_size, threads=threads, reference=reference,
+        sample_fraction=sample_fraction, **quantify_params)
+    progress, genome_done = 0, 0
+    with multiprocessing.Pool(processes) as pool, \
+            _open_skipped(skipped, header, threads=threads, reference=reference) as strange_bam:
+        if checkpoint is None:
+            for region_size, result in zip(region_sizes, pool.imap(worker, tasks)):
+                _add_region_result(result, single, multi, metrics, strange_bam)
+
+                genome_done += region_size
+                if report_progress:
+                    # pylint: disable=protected-access
+                    progress = iCount._log_progress(genome_done / genome_size, progress, LOGGER)
+        else:
+            results = pool.imap(worker, [task for task in tasks if not checkpoint.is_done(task[2][0])])
+            by_chrom = itertools.groupby(zip(tasks, region_sizes), key=lambda item: item[0][2][0])
+            for chrom, chrom_regions in by_chrom:
+                chrom_sizes = [region_size for _, region_size in chrom_regions]
+                if not checkpoint.is_done(chrom):
+                    checkpoint.save(chrom, functools.partial(
+                        _merge_region_results, itertools.islice(results, len(chrom_sizes)),
+                        header=header, barcode_counter_size=barcode_counter_size, threads=threads))
+                _add_region_result(checkpoint.load(chrom), single, multi, metrics, strange_bam,
+                                   remove_skipped=False)
+
+                genome_done += sum(chrom_sizes)
+                if report_progress:
+                    # pylint: disable=protected-access
+                    progress = iCount._log_progress(genome_done / genome_size, progress, LOGGER)
+
+    # Clean up:
+    for tmp_file in tmp_files:
+        os.remove(tmp_file)
+
+    _report_metrics(metrics, skipped)
 
 
 def run(bam, sites_single, sites_multi, skipped, group_by='start', quant='cDNA',
         segmentation=None, mismatches=1, mapq_th=0, multimax=50, gap_th=4, ratio_th=0.1,
-        max_barcodes=10000, report_progress=False):
+        max_barcodes=10000, report_progress=False, processes=1, sort_memory='768M', threads=1,
+        barcode_tag=None, barcode_counter_size=10000, checkpoint_dir=None, resume=False,
+        regions=None, reference=None, sample_fraction=1.0, state=None, umi_method='ratio'):
     """
     Identify and quantify cross-linked sites.
 
@@ -649,13 +821,14 @@ def run(bam, sites_single, sites_multi, skipped, group_by='start', quant='cDNA',
     Parameters
     ----------
     bam : str
-        Input BAM file with mapped reads.
+        Input BAM or CRAM file with mapped reads.
     sites_single : str
         Output BED6 file to store data from single mapped reads.
     sites_multi : str
         Output BED6 file to store data from single and multi-mapped reads.
     skipped : str
-        Output BAM file to store reads that do not map as expected by segmentation and
+        Output BAM (or CRAM, if name ends with .cram) file to store reads that
+        do not map as expected by segmentation and
         reference genome sequence. If read's second start does not fall on any of
         segmentation borders, it is considered problematic. If segmentation is not provided,
         every read in two parts with gap longer than gap_th is not used (skipped).
@@ -685,6 +858,52 @@ def run(bam, sites_single, sites_multi, skipped, group_by='start', quant='cDNA',
     max_barcodes : int
         Skip merging similar barcodes if number of distinct barcodes at
         position is higher that this.
+    processes : int
+        Number of processes to use. If larger than 1, chromosomes (or chunks of
+        long chromosomes) are processed in parallel.
+    sort_memory : str
+        Maximum memory per thread used when input BAM file needs to be sorted
+        (for example 768M or 2G). Coordinate sorted input with up-to-date index
+        is used in place.
+    threads : int
+        Number of threads used for BAM compression and decompression (in
+        each process) and when input BAM file needs to be sorted.
+    barcode_tag : str
+        Read randomers from this BAM tag (for example RX or BX) instead of
+        from read names.
+    barcode_counter_size : int
+        Number of randomers tracked when counting the most frequent
+        randomers, reported in metrics. Counts are exact if there are at most
+        this many distinct randomers. If 0, all randomers are counted exactly.
+    checkpoint_dir : str
+        Directory to store results of each completed chromosome in. Input is
+        then processed in regions, as with multiple processes.
+    resume : bool
+        Reuse results of chromosomes, completed by previous interrupted run
+        with the same input and parameters, from ``checkpoint_dir``.
+    regions : str
+        BED or GTF file with target intervals. If given, only reads with
+        cross-link position inside target intervals (on any strand) are
+        used. Input is then processed in regions, as with multiple processes.
+    reference : str
+        FASTA file with reference genome, needed for CRAM input or output.
+    sample_fraction : float
+        Use only this fraction of reads, for fast approximate results. Reads
+        are selected by hash of read name, so all hits of multimapped read are
+        used or skipped together and the same reads are selected in each run.
+        Scores are divided by ``sample_fraction``. Fraction is stored in
+        metrics.
+    state : str
+        File to store hits on each cross-link position in. Reads from
+        additional BAM files (for example from top-up sequencing) can then be
+        added with ``iCount xlsites_update``. Can only be used when input is
+        processed in single process, without checkpoint and regions.
+    umi_method : str
+        Method of merging similar randomers. With 'ratio', randomers below
+        ``ratio_th`` are merged into similar ones. With 'directional', less
+        frequent randomer is merged into similar randomer with at least
+        twice as many reads (minus one), as in directional network method.
+        Then ``ratio_th`` and ``max_barcodes`` are not used.
 
     Returns
     -------
@@ -696,39 +915,74 @@ def run(bam, sites_single, sites_multi, skipped, group_by='start', quant='cDNA',
 
     assert sites_single.endswith(('.bed', '.bed.gz'))
     assert sites_multi.endswith(('.bed', '.bed.gz'))
-    assert skipped.endswith(('.bam'))
+    assert skipped.endswith(('.bam', '.cram'))
     assert quant in ['cDNA', 'reads']
     assert group_by in ['start', 'middle', 'end']
+    assert processes >= 1
+    assert threads >= 1
+    assert checkpoint_dir or not resume
+    assert 0 < sample_fraction <= 1
+    assert not state or (processes == 1 and not checkpoint_dir and not regions)
+    assert umi_method in ['ratio', 'directional']
+    if skipped.endswith('.cram') and not reference:
+        raise ValueError('Parameter reference is needed to write CRAM file {}.'.format(skipped))
 
     metrics = iCount.Metrics()
+    params = {
+        'group_by': group_by,
+        'segmentation': segmentation,
+        'mismatches': mismatches,
+        'mapq_th': mapq_th,
+        'multimax': multimax,
+        'gap_th': gap_th,
+        'ratio_th': ratio_th,
+        'max_barcodes': max_barcodes,
+        'barcode_tag': barcode_tag,
+        'barcode_counter_size': barcode_counter_size,
+        'regions': regions,
+        'sample_fraction': sample_fraction,
+        'umi_method': umi_method,
+    }
+
+    checkpoint = None
+    if checkpoint_dir:
+        checkpoint = _Checkpoint(checkpoint_dir, bam, params, resume=resume)
 
     single, multi = {}, {}
-    progress = 0
-    for (chrom, strand), new_progress, by_pos in _processs_bam_file(
-            bam, metrics, mapq_th, skipped, segmentation, gap_th):
-        if report_progress:
-            # pylint: disable=protected-access
-            progress = iCount._log_progress(new_progress, progress, LOGGER)
-
-        single_by_pos = {}
-        multi_by_pos = {}
-        for xlink_pos, by_bc in by_pos.items():
-
-            _merge_similar_randomers(by_bc, mismatches, max_barcodes, ratio_th=ratio_th)
+    if processes > 1 or checkpoint is not None or regions:
+        _processs_bam_file_parallel(
+            bam, metrics, mapq_th, skipped, single, multi, processes, segmentation=segmentation,
+            gap_th=gap_th, report_progress=report_progress, sort_memory=sort_memory,
+            threads=threads, barcode_tag=barcode_tag, barcode_counter_size=barcode_counter_size,
+            checkpoint=checkpoint, regions=regions, reference=reference,
+            sample_fraction=sample_fraction, group_by=group_by, mismatches=mismatches,
+            multimax=multimax, ratio_th=ratio_th, max_barcodes=max_barcodes,
+            umi_method=umi_method)
+    else:
+        progress = 0
+        state_writer = _StateWriter(state, params) if state else None
+        for (chrom, strand), new_progress, by_pos in _processs_bam_file(
+                bam, metrics, mapq_th, skipped, segmentation, gap_th, sort_memory=sort_memory,
+                threads=threads, barcode_tag=barcode_tag,
+                barcode_counter_size=barcode_counter_size, reference=reference,
+                sample_fraction=sample_fraction):
+            if report_progress:
+                # pylint: disable=protected-access
+                progress = iCount._log_progress(new_progress, progress, LOGGER)
 
-            # count single mapped reads only
-            _update(single_by_pos, _collapse(xlink_pos, by_bc, group_by, multimax=1))
-            # count all reads mapped les than multimax times
-            _update(multi_by_pos, _collapse(xlink_pos, by_bc, group_by, multimax=multimax))
+            if state_writer:
+                # Hits are stored before they are modified by merging.
+                state_writer.add((chrom, strand), by_pos)
+            _quantify(by_pos, single.setdefault((chrom, strand), {}),
+                      multi.setdefault((chrom, strand), {}), group_by, mismatches, multimax,
+                      ratio_th, max_barcodes, umi_method=umi_method)
 
-        single.setdefault((chrom, strand), {}).update(single_by_pos)
-        multi.setdefault((chrom, strand), {}).update(multi_by_pos)
+    metrics.sample_fraction = sample_fraction
+    if state:
+        state_writer.close(single, multi, metrics)
 
     # Write output
-    val_index = ['cDNA', 'reads'].index(quant)
-    _save_dict(single, sites_single, val_index=val_index)
-    LOGGER.info('Saved to BED file (single mapped reads): %s', sites_single)
-    _save_dict(multi, sites_multi, val_index=val_index)
-    LOGGER.info('Saved to BED file (multi-mapped reads): %s', sites_multi)
+    _save_results(single, multi, sites_single, sites_multi, quant,
+                  sample_fraction=sample_fraction)
 
     return metrics
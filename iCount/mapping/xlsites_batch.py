@@ -0,0 +1,171 @@
+""".. Line to protect from pydocstyle D205, D400.
+
+Identify and quantify cross-linked sites in multiple samples
+------------------------------------------------------------
+
+Identify and quantify cross-linked sites in multiple BAM files.
+
+Each line of tab-separated ``manifest`` file describes one sample with four
+columns: input BAM (or CRAM) file and output files ``sites_single``, ``sites_multi``
+and ``skipped``, as in ``iCount xlsites``. Empty lines and lines starting
+with ``#`` are ignored. Segmentation is read only once for all samples and
+regions of all BAM files are processed by a common pool of ``processes``
+workers. Results for each sample are the same as if it would be processed
+by ``iCount xlsites``.
+"""
+import os
+import logging
+import functools
+import itertools
+import multiprocessing
+
+from pysam import AlignmentFile  # pylint: disable=no-name-in-module
+
+import iCount
+from iCount.files.bam import ensure_sorted_indexed
+from iCount.mapping.xlsites import _add_region_result, _get_region_tasks, _init_metrics, \
+    _load_segment_borders, _open_skipped, _process_region, _report_metrics
+from iCount.mapping.xlsites_common import _save_results
+
+LOGGER = logging.getLogger(__name__)
+
+
+def run(manifest, group_by='start', quant='cDNA', segmentation=None, mismatches=1,
+        mapq_th=0, multimax=50, gap_th=4, ratio_th=0.1, max_barcodes=10000,
+        report_progress=False, processes=1, sort_memory='768M', threads=1,
+        barcode_tag=None, barcode_counter_size=10000, regions=None, reference=None,
+        umi_method='ratio'):
+    """
+    Identify and quantify cross-linked sites in multiple BAM files.
+
+    Parameters
+    ----------
+    manifest : str
+        Tab-separated file with input BAM file and output files for each sample.
+    group_by : str
+        Assign score of a read to either 'start', 'middle' or 'end' nucleotide.
+    quant : str
+        Report number of 'cDNA' or number of 'reads'.
+    segmentation : str
+        File with custon segmentation format (obtained by ``iCount segment``).
+    mismatches : int
+        Reads on same position with random barcode differing less than
+        ``mismatches`` are merged together, if their ratio is below ratio_th.
+    mapq_th : int
+        Ignore hits with MAPQ < mapq_th.
+    multimax : int
+        Ignore reads, mapped to more than ``multimax`` places.
+    gap_th : int
+        Reads with gaps less than gap_th are treated as if they have no gap.
+    ratio_th : float
+        Ratio between the number of reads supporting a randomer versus the
+        number of reads supporting the most frequent randomer. All randomers
+        above this threshold are accepted as unique. Remaining are merged
+        with the rest, allowing for the specified number of mismatches.
+    max_barcodes : int
+        Skip merging similar barcodes if number of distinct barcodes at
+        position is higher that this.
+    report_progress : bool
+        Switch to report progress.
+    processes : int
+        Number of processes to use.
+    sort_memory : str
+        Maximum memory per thread used when input BAM file needs to be sorted
+        (for example 768M or 2G). Coordinate sorted input with up-to-date index
+        is used in place.
+    threads : int
+        Number of threads used for BAM compression and decompression (in
+        each process) and when input BAM file needs to be sorted.
+    barcode_tag : str
+        Read randomers from this BAM tag (for example RX or BX) instead of
+        from read names.
+    barcode_counter_size : int
+        Number of randomers tracked when counting the most frequent
+        randomers, reported in metrics. Counts are exact if there are at most
+        this many distinct randomers. If 0, all randomers are counted exactly.
+    regions : str
+        BED or GTF file with target intervals. If given, only reads with
+        cross-link position inside target intervals (on any strand) are
+        used.
+    reference : str
+        FASTA file with reference genome, needed for CRAM input or output.
+    umi_method : str
+        Method of merging similar randomers, 'ratio' or 'directional'.
+
+    Returns
+    -------
+    list
+        Metrics object, storing analysis metadata, for each sample.
+
+    """
+    iCount.log_inputs(LOGGER, level=logging.INFO)  # pylint: disable=protected-access
+
+    assert quant in ['cDNA', 'reads']
+    assert group_by in ['start', 'middle', 'end']
+    assert processes >= 1
+    assert threads >= 1
+    assert umi_method in ['ratio', 'directional']
+
+    samples = []
+    with open(manifest) as handle:
+        for line in handle:
+            if not line.strip() or line.startswith('#'):
+                continue
+            bam, sites_single, sites_multi, skipped = line.rstrip('\n').split('\t')
+            assert sites_single.endswith(('.bed', '.bed.gz'))
+            assert sites_multi.endswith(('.bed', '.bed.gz'))
+            assert skipped.endswith(('.bam', '.cram'))
+            if skipped.endswith('.cram') and not reference:
+                raise ValueError('Parameter reference is needed to write CRAM file {}.'.format(skipped))
+            samples.append((bam, sites_single, sites_multi, skipped))
+
+    borders = _load_segment_borders(segmentation) if segmentation else None
+
+    # Split all BAM files into regions, that are processed by common pool of workers:
+    tasks, sorted_bams, task_counts, tmp_files = [], [], [], []
+    for bam, _, _, _ in samples:
+        bam_sorted, index, bam_tmp_files = ensure_sorted_indexed(
+            bam, sort_memory=sort_memory, threads=threads, reference=reference)
+        bam_tasks, _ = _get_region_tasks(
+            bam_sorted, index, processes, borders=borders, regions=regions)
+        tasks.extend(bam_tasks)
+        sorted_bams.append((bam_sorted, index))
+        task_counts.append(len(bam_tasks))
+        tmp_files.extend(bam_tmp_files)
+
+    LOGGER.info('Detecting cross-links in %d samples with %d processes...', len(samples),
+                processes)
+    worker = functools.partial(
+        _process_region, mapq_th=mapq_th, gap_th=gap_th, barcode_tag=barcode_tag,
+        barcode_counter_size=barcode_counter_size, group_by=group_by, mismatches=mismatches,
+        multimax=multimax, ratio_th=ratio_th, max_barcodes=max_barcodes, threads=threads,
+        reference=reference, umi_method=umi_method)
+    all_metrics = []
+    progress = 0
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.imap(worker, tasks)
+        for sample_index, ((bam, sites_single, sites_multi, skipped), (bam_sorted, index),
+                           task_count) in enumerate(zip(samples, sorted_bams, task_counts)):
+            metrics = iCount.Metrics()
+            _init_metrics(metrics, barcode_counter_size=barcode_counter_size)
+            single, multi = {}, {}
+            with AlignmentFile(bam_sorted, 'rb', index_filename=index) as bamfile, \
+                    _open_skipped(skipped, bamfile.header, threads=threads,
+                                  reference=reference) as strange_bam:
+                for result in itertools.islice(results, task_count):
+                    _add_region_result(result, single, multi, metrics, strange_bam)
+
+            LOGGER.info('Sample: %s', bam)
+            _report_metrics(metrics, skipped)
+            _save_results(single, multi, sites_single, sites_multi, quant)
+            all_metrics.append(metrics)
+
+            if report_progress:
+                # pylint: disable=protected-access
+                progress = iCount._log_progress((sample_index + 1) / len(samples), progress, LOGGER)
+
+    # Clean up:
+    for tmp_file in tmp_files:
+        os.remove(tmp_file)
+
+    return all_metrics
@@ -0,0 +1,103 @@
+""".. Line to protect from pydocstyle D205, D400.
+
+Checkpoints of cross-link detection
+-----------------------------------
+
+Store results of completed chromosomes, so interrupted run can be resumed.
+"""
+import os
+import json
+import pickle
+import logging
+
+
+LOGGER = logging.getLogger(__name__)
+#: Name of file in checkpoint directory that describes completed shards.
+CHECKPOINT_MANIFEST = 'manifest.json'
+
+
+def _file_key(fname):
+    """Return size and modification time (in nanoseconds) of file ``fname``."""
+    stat = os.stat(fname)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class _Checkpoint:
+    """
+    Results of completed chromosomes, stored as shards in ``directory``.
+
+    Results of each chromosome are stored in two shards: pickled counts and
+    metrics and BAM file with skipped records. File ``CHECKPOINT_MANIFEST``
+    records size and modification time of input BAM file, parameters of
+    analysis and shards of completed chromosomes. Shards are renamed into
+    place and manifest is updated only when chromosome is complete, so
+    interrupted run can be resumed from shards listed in manifest.
+
+    If ``resume`` is False, existing shards are ignored and overwritten.
+    Resuming from checkpoint made from different input or with different
+    parameters raises ValueError. Input is compared by size and modification
+    time, so large BAM files are not read just to check them. Input that was
+    modified (or copied) after checkpoint was made is treated as different.
+    """
+
+    def __init__(self, directory, bam_fname, params, resume=False):
+        """Initialize checkpoint, reading its manifest if ``resume`` is True."""
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.manifest = {
+            'bam': os.path.abspath(bam_fname),
+            'key': _file_key(bam_fname),
+            'parameters': params,
+            'chromosomes': {},
+        }
+
+        manifest_fname = os.path.join(directory, CHECKPOINT_MANIFEST)
+        if resume and os.path.isfile(manifest_fname):
+            with open(manifest_fname, 'rt') as handle:
+                previous = json.load(handle)
+            if previous.get('key') != self.manifest['key']:
+                raise ValueError('Checkpoint in {} was made from different BAM file.'.format(directory))
+            if previous['parameters'] != params:
+                raise ValueError('Checkpoint in {} was made with different parameters: {}'.format(
+                    directory, previous['parameters']))
+            self.manifest['chromosomes'] = previous['chromosomes']
+            LOGGER.info('Resuming from checkpoint with %d completed chromosomes.',
+                        len(self.manifest['chromosomes']))
+        self._save_manifest()
+
+    def _save_manifest(self):
+        """Atomically replace manifest file."""
+        manifest_fname = os.path.join(self.directory, CHECKPOINT_MANIFEST)
+        with open(manifest_fname + '.tmp', 'wt') as handle:
+            json.dump(self.manifest, handle, indent=2, sort_keys=True)
+        os.replace(manifest_fname + '.tmp', manifest_fname)
+
+    def is_done(self, chrom):
+        """Check if results of chromosome ``chrom`` are stored in checkpoint."""
+        return chrom in self.manifest['chromosomes']
+
+    def save(self, chrom, merge_results):
+        """
+        Store results of chromosome ``chrom`` in its shards.
+
+        Function ``merge_results`` is called with name of BAM file, into which
+        skipped records are written, and returns counts and metrics.
+        """
+        name = 'shard{}'.format(len(self.manifest['chromosomes']))
+        fname = os.path.join(self.directory, name)
+
+        single, multi, metrics = merge_results(fname + '.bam.tmp')
+        with open(fname + '.pkl.tmp', 'wb') as handle:
+            pickle.dump((single, multi, metrics), handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(fname + '.bam.tmp', fname + '.bam')
+        os.replace(fname + '.pkl.tmp', fname + '.pkl')
+        self.manifest['chromosomes'][chrom] = name
+        self._save_manifest()
+
+    def load(self, chrom):
+        """Return counts, metrics and name of BAM file with skipped records of chromosome ``chrom``."""
+        fname = os.path.join(self.directory, self.manifest['chromosomes'][chrom])
+        with open(fname + '.pkl', 'rb') as handle:
+            single, multi, metrics = pickle.load(handle)
+        return single, multi, metrics, fname + '.bam'
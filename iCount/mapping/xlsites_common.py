@@ -0,0 +1,291 @@
+""".. Line to protect from pydocstyle D205, D400.
+
+Common functions of cross-link detection
+----------------------------------------
+
+Count cross-link events on positions and store hits in state file.
+
+Functions are shared by ``iCount xlsites``, ``iCount xlsites_batch`` and
+``iCount xlsites_update``.
+"""
+import os
+import pickle
+import logging
+
+from iCount.files import _f2s, gz_open
+from iCount.mapping.randomers import _Hits, _merge_similar_randomers
+
+LOGGER = logging.getLogger(__name__)
+#: Version of format of state files written by ``iCount xlsites`` and ``xlsites_update``.
+STATE_VERSION = 1
+
+
+def _save_dict(bed, out_fname, val_index=None, scale=1):
+    """
+    Save data from dict to BED6 file, sorted by chromosome and position.
+
+    Sites on the same position are ordered by strand. Output is compressed
+    if ``out_fname`` ends with ``.gz``. Scores are multiplied by ``scale``.
+    """
+    by_chrom = {}
+    for (chrom, strand), by_pos in bed.items():
+        by_chrom.setdefault(chrom, []).append((strand, by_pos))
+
+    with gz_open(out_fname, 'wt') as handle:
+        for chrom in sorted(by_chrom):
+            sites = sorted((pos, strand, val) for strand, by_pos in by_chrom[chrom]
+                           for pos, val in by_pos.items())
+            handle.writelines('{}\t{}\t{}\t.\t{}\t{}\n'.format(
+                chrom, pos, pos + 1, _f2s((val if val_index is None else val[val_index]) * scale),
+                strand) for pos, strand, val in sites)
+
+
+def _update(cur_vals, to_add):
+    """
+    Add the values from ``to_add`` to appropriate place in ``cur_vals``.
+
+    Note: cur_vals is updated in place!
+
+    Parameters
+    ----------
+    to_add : dict
+        Dict with update data.
+
+    Returns
+    -------
+    None
+        None.
+
+    """
+    for pos, vals_to_add in to_add.items():
+        prev_vals = cur_vals.get(pos, [0] * len(vals_to_add))
+        cur_vals[pos] = [p + n for p, n in zip(prev_vals, vals_to_add)]
+
+
+def _subtract(cur_vals, to_subtract):
+    """
+    Subtract values in ``to_subtract`` from appropriate place in ``cur_vals``.
+
+    Positions that are left without reads are removed. Note: cur_vals is
+    updated in place!
+    """
+    for pos, vals in to_subtract.items():
+        new_vals = [p - n for p, n in zip(cur_vals[pos], vals)]
+        if new_vals[1] == 0:
+            del cur_vals[pos]
+        else:
+            cur_vals[pos] = new_vals
+
+
+def _collapse_tiers(xlink_pos, by_bc, group_by, multimax_tiers):
+    """
+    Report number of cDNAs and reads in cross-link site on xlink_pos for each multimax tier.
+
+    Input parameter `by_bc` has te following structure:
+    by_bc = {
+        'AAA': [(middle_pos, end_pos, read_len, num_mapped, cigar, second_start),  # hit1
+                (middle_pos, end_pos, read_len, num_mapped, cigar, second_start),  # hit2
+                (middle_pos, end_pos, read_len, num_mapped, cigar, second_start),  # ...
+        ]
+        'AAT': [(middle_pos, end_pos, read_len, num_mapped, cigar, second_start),  # hit1
+                (middle_pos, end_pos, read_len, num_mapped, cigar, second_start),  # hit2
+                ]
+
+    Counting the number of reads is easy - just count the number of hits per
+    cross-link site.
+
+    Counting the number of cDNAs is also easy - just count the number of
+    different barcodes. However, following scenarions also need to be handled:
+
+        * one read ban be mapped to multiple sites. In this case, the
+          "contribution" of such read has to be divided equally to all positions
+          that it maps to.
+        * Also, longer reads should have proportionally greater "contribution".
+          than the short ones.
+
+    Upper two scenarions imply that each read contributes::
+
+        weight = 1 * 1/a * b/c
+        # a = number of hits
+        # b = read length
+        # c = sum(read lengths per same barcode)
+
+    Another factor to take into account is also the possibility that a group of
+    reads with equal start position and barcode represents multiple cross-links.
+    Imagine a read starting 10 bp before exon-intron junction. One group of
+    reads maps in the intron section and other reads skip the intron and map on
+    next exon with the second part of the read. This can be solved by grouping
+    by "second_start", which is the coordinate of the first nucleotide of the
+    second part of the read. Each group with unique second start is treated as
+    an independent cross-link event. This is done in function
+    ``_separate_by_second_starts``
+
+    Counts are computed for each of thresholds in ``multimax_tiers`` in a
+    single traversal of ``by_bc``. Each threshold ignores reads mapped to more
+    than the threshold number of places. Returns a list with one object
+    ``counts`` per threshold::
+
+        counts = {
+            position: [cDNA_count, reads_count],
+            123: [3.14, 42],
+            124: [5.79, 16],
+            ...
+        }
+
+    Parameters
+    ----------
+    xlink_pos : int
+        Cross link position (genomic coordinate).
+    by_bc : dict
+        Dict with hits for each barcode.
+    group_by : str
+        Report by start, middle or end position.
+    multimax_tiers : list
+        Thresholds for number of places the read is mapped to.
+
+    Returns
+    -------
+    list
+        Number of cDNA and reads for each position, for each threshold.
+
+    """
+    group_by_index = ['start', 'middle', 'end'].index(group_by)
+
+    # Containers for cDNA and read counts:
+    tiers = [{} for _ in multimax_tiers]
+
+    for hits in by_bc.values():
+
+        # separate in groups by second-start
+        ss_groups = {}
+        for read in hits:
+            ss_groups.setdefault(read[4], []).append(read)
+
+        for ss_group in ss_groups.values():
+
+            # Sum of all read lengths per ss_group, for each threshold:
+            sums_len_per_barcode = [0] * len(multimax_tiers)
+            for read in ss_group:
+                for tier, multimax in enumerate(multimax_tiers):
+                    if read[3] <= multimax:
+                        sums_len_per_barcode[tier] += read[2]
+
+            for middle_pos, end_pos, read_len, num_mapped, _ in ss_group:
+                grp_pos = (xlink_pos, middle_pos, end_pos)[group_by_index]
+                for counts, multimax, sum_len_per_barcode in zip(
+                        tiers, multimax_tiers, sums_len_per_barcode):
+                    if num_mapped > multimax:
+                        continue
+                    weight = read_len / (num_mapped * sum_len_per_barcode)
+
+                    current_values = counts.get(grp_pos, (0, 0))
+                    upadated_values = (current_values[0] + weight, current_values[1] + 1)
+                    counts[grp_pos] = upadated_values
+
+    return tiers
+
+
+def _collapse(xlink_pos, by_bc, group_by, multimax=1):
+    """
+    Report number of cDNAs and reads in cross-link site on xlink_pos.
+
+    Ignore reads, mapped to more than ``multimax`` places. See
+    ``_collapse_tiers`` for details.
+    """
+    return _collapse_tiers(xlink_pos, by_bc, group_by, [multimax])[0]
+
+
+def _quantify(by_pos, single, multi, group_by, mismatches, multimax, ratio_th, max_barcodes,
+              umi_method='ratio'):
+    """Merge randomers on each cross-link position and add counts to ``single`` and ``multi``."""
+    for xlink_pos, by_bc in by_pos.items():
+
+        _merge_similar_randomers(by_bc, mismatches, max_barcodes, ratio_th=ratio_th,
+                                 umi_method=umi_method)
+
+        # count single mapped reads and all reads mapped les than multimax times
+        single_counts, multi_counts = _collapse_tiers(xlink_pos, by_bc, group_by, [1, multimax])
+        _update(single, single_counts)
+        _update(multi, multi_counts)
+
+
+def _save_results(single, multi, sites_single, sites_multi, quant, sample_fraction=1.0):
+    """
+    Save counts of single and multi-mapped reads to BED files.
+
+    Counts from subsample of reads are divided by ``sample_fraction`` to
+    estimate counts of the whole library.
+    """
+    val_index = ['cDNA', 'reads'].index(quant)
+    scale = 1 / sample_fraction if sample_fraction < 1 else 1
+    _save_dict(single, sites_single, val_index=val_index, scale=scale)
+    LOGGER.info('Saved to BED file (single mapped reads): %s', sites_single)
+    _save_dict(multi, sites_multi, val_index=val_index, scale=scale)
+    LOGGER.info('Saved to BED file (multi-mapped reads): %s', sites_multi)
+
+
+def _pack_hits(by_bc):
+    """Convert hits of each barcode to bytes, for compact storage in state file."""
+    return {barcode: hits.tobytes() for barcode, hits in by_bc.items()}
+
+
+def _unpack_hits(packed):
+    """Convert hits of each barcode from bytes, as stored by ``_pack_hits``."""
+    return {barcode: _Hits.frombytes(data) for barcode, data in packed.items()}
+
+
+class _StateWriter:
+    """
+    Writer of file with hits on each cross-link position.
+
+    State file is a stream of pickled records. The first one is a dict with
+    format version and parameters of analysis. It is followed by any number
+    of ``((chrom, strand), by_pos)`` records with hits (as stored by
+    ``_pack_hits``) on each cross-link position. Each position is stored in
+    one record only. The last record is ``(None, (single, multi, metrics))``
+    with counts on all positions and metrics. Hits are stored before similar
+    randomers are merged, so that merging can be repeated when new reads are
+    added by ``xlsites_update``.
+    """
+
+    def __init__(self, fname, params):
+        """Open temporary file next to ``fname`` and write header."""
+        self.fname = fname
+        self.handle = open(fname + '.tmp', 'wb')
+        self.dump({'version': STATE_VERSION, 'parameters': params})
+
+    def dump(self, record):
+        """Write one record."""
+        pickle.dump(record, self.handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def add(self, chrom_strand, by_pos):
+        """Write hits on positions ``by_pos`` on ``chrom_strand``."""
+        self.dump((chrom_strand, {pos: _pack_hits(by_bc) for pos, by_bc in by_pos.items()}))
+
+    def close(self, single, multi, metrics):
+        """Write counts and metrics and move file into place."""
+        self.dump((None, (single, multi, metrics)))
+        self.handle.close()
+        os.replace(self.fname + '.tmp', self.fname)
+
+
+def _read_state(handle):
+    """
+    Read records from state file ``handle``, written by ``_StateWriter``.
+
+    Yields
+    ------
+    tuple
+        Parameters of analysis first and then each record after header.
+
+    """
+    header = pickle.load(handle)
+    if not isinstance(header, dict) or header.get('version') != STATE_VERSION:
+        raise ValueError('File {} is not xlsites state file of version {}.'.format(
+            handle.name, STATE_VERSION))
+    yield header['parameters']
+    while True:
+        record = pickle.load(handle)
+        yield record
+        if record[0] is None:
+            return
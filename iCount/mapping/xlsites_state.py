@@ -0,0 +1,169 @@
+""".. Line to protect from pydocstyle D205, D400.
+
+Update cross-linked sites with additional reads
+-----------------------------------------------
+
+Add reads from additional BAM files to cross-linked sites stored in state file.
+
+State file is written by ``iCount xlsites`` with ``--state`` option. It
+stores hits on each cross-link position before similar randomers are merged,
+so that ``iCount xlsites_update`` can add reads from additional BAM files
+(for example from top-up sequencing of the same library) without processing
+all reads again.
+"""
+import os
+import logging
+
+from pysam import AlignmentFile  # pylint: disable=no-name-in-module
+
+import iCount
+from iCount.files import get_temp_file_name
+from iCount.mapping.randomers import _Hits
+from iCount.mapping.xlsites import _merge_metrics, _open_skipped, _processs_bam_file
+from iCount.mapping.xlsites_common import _StateWriter, _pack_hits, _quantify, _read_state, \
+    _save_results, _subtract, _unpack_hits, _update
+
+LOGGER = logging.getLogger(__name__)
+
+
+def xlsites_update(state, sites_single, sites_multi, skipped, bams, quant='cDNA',
+                   report_progress=False, sort_memory='768M', threads=1, reference=None):
+    """
+    Add reads from additional BAM files to cross-linked sites stored in state file.
+
+    State file is made by ``iCount xlsites`` with ``--state`` option. Reads
+    from ``bams`` (for example from top-up sequencing of the same library)
+    are processed with parameters stored in state file. Similar randomers are
+    merged again only on cross-link positions that received new reads, so
+    results are the same as when all reads are processed together, but time
+    of merging is proportional to the number of new reads. State file is
+    updated in place, so further BAM files can be added later.
+
+    Parameters
+    ----------
+    state : str
+        State file made by ``iCount xlsites``.
+    sites_single : str
+        Output BED6 file to store data from single mapped reads.
+    sites_multi : str
+        Output BED6 file to store data from single and multi-mapped reads.
+    skipped : str
+        Output BAM (or CRAM, if name ends with .cram) file to store reads
+        from ``bams`` that do not map as expected by segmentation.
+    bams : list_str
+        BAM or CRAM files with additional mapped reads.
+    quant : str
+        Report number of 'cDNA' or number of 'reads'.
+    report_progress : bool
+        Switch to report progress.
+    sort_memory : str
+        Maximum memory per thread used when input BAM file needs to be sorted
+        (for example 768M or 2G).
+    threads : int
+        Number of threads used for BAM compression and decompression and
+        when input BAM file needs to be sorted.
+    reference : str
+        FASTA file with reference genome, needed for CRAM input or output.
+
+    Returns
+    -------
+    iCount.Metrics
+        Metrics object, storing analysis metadata of all reads.
+
+    """
+    # pylint: disable=protected-access
+    iCount.log_inputs(LOGGER, level=logging.INFO)
+
+    if not bams:
+        raise ValueError('At least one BAM file with additional reads is needed.')
+    assert sites_single.endswith(('.bed', '.bed.gz'))
+    assert sites_multi.endswith(('.bed', '.bed.gz'))
+    assert skipped.endswith(('.bam', '.cram'))
+    assert quant in ['cDNA', 'reads']
+    assert threads >= 1
+    if skipped.endswith('.cram') and not reference:
+        raise ValueError('Parameter reference is needed to write CRAM file {}.'.format(skipped))
+
+    with open(state, 'rb') as handle:
+        params = next(_read_state(handle))
+    quantify_params = [params['group_by'], params['mismatches'], params['multimax'],
+                       params['ratio_th'], params['max_barcodes'], params['umi_method']]
+
+    # Collect hits of new reads, skipped records are first stored for each BAM file:
+    new_hits = {}
+    new_metrics = []
+    bam_skipped = []
+    progress = 0
+    for bam_index, bam in enumerate(bams):
+        metrics = iCount.Metrics()
+        bam_skipped.append(get_temp_file_name(extension='bam'))
+        for chrom_strand, new_progress, by_pos in _processs_bam_file(
+                bam, metrics, params['mapq_th'], bam_skipped[-1], params['segmentation'],
+                params['gap_th'], sort_memory=sort_memory, threads=threads,
+                barcode_tag=params['barcode_tag'],
+                barcode_counter_size=params['barcode_counter_size'], reference=reference,
+                sample_fraction=params['sample_fraction']):
+            hits = new_hits.setdefault(chrom_strand, {})
+            for pos, by_bc in by_pos.items():
+                for barcode, bc_hits in by_bc.items():
+                    hits.setdefault(pos, {}).setdefault(barcode, _Hits()).extend(bc_hits)
+            if report_progress:
+                progress = iCount._log_progress(
+                    (bam_index + new_progress) / len(bams), progress, LOGGER)
+        new_metrics.append(metrics)
+
+    with AlignmentFile(bam_skipped[0], 'rb') as bamfile:
+        header = bamfile.header
+    with _open_skipped(skipped, header, threads=threads, reference=reference) as strange_bam:
+        for fname in bam_skipped:
+            with AlignmentFile(fname, 'rb') as bamfile:
+                for read in bamfile.fetch(until_eof=True):
+                    strange_bam.write(read)
+            os.remove(fname)
+
+    # Replace counts of touched positions while copying state into new state file:
+    LOGGER.info('Updating cross-links on %d positions...',
+                sum(len(by_pos) for by_pos in new_hits.values()))
+    removed = {}, {}
+    added = {}, {}
+    with open(state, 'rb') as handle:
+        records = _read_state(handle)
+        state_writer = _StateWriter(state, next(records))
+        for chrom_strand, packed in records:
+            if chrom_strand is None:
+                single, multi, metrics = packed
+                break
+            touched = new_hits.get(chrom_strand, {})
+            for pos in touched.keys() & packed.keys():
+                by_bc = _unpack_hits(packed[pos])
+                _quantify({pos: by_bc}, *[counts.setdefault(chrom_strand, {}) for counts in removed],
+                          *quantify_params)
+
+                by_bc = _unpack_hits(packed[pos])
+                for barcode, bc_hits in touched.pop(pos).items():
+                    by_bc.setdefault(barcode, _Hits()).extend(bc_hits)
+                packed[pos] = _pack_hits(by_bc)
+                _quantify({pos: by_bc}, *[counts.setdefault(chrom_strand, {}) for counts in added],
+                          *quantify_params)
+            state_writer.dump((chrom_strand, packed))
+
+        # Positions without reads in state file:
+        for chrom_strand, by_pos in new_hits.items():
+            if by_pos:
+                state_writer.add(chrom_strand, by_pos)
+                _quantify(by_pos, *[counts.setdefault(chrom_strand, {}) for counts in added],
+                          *quantify_params)
+
+    for counts, counts_added, counts_removed in zip([single, multi], added, removed):
+        for chrom_strand, by_pos in counts_added.items():
+            _update(counts.setdefault(chrom_strand, {}), by_pos)
+        for chrom_strand, by_pos in counts_removed.items():
+            _subtract(counts[chrom_strand], by_pos)
+    for bam_metrics in new_metrics:
+        _merge_metrics(metrics, bam_metrics)
+    state_writer.close(single, multi, metrics)
+
+    _save_results(single, multi, sites_single, sites_multi, quant,
+                  sample_fraction=params['sample_fraction'])
+
+    return metrics
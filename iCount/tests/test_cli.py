@@ -309,6 +309,58 @@ class TestCLI(unittest.TestCase):
         self.assertEqual(subprocess.call(command_basic), 0)
         self.assertEqual(subprocess.call(command_full), 0)
 
+    def test_xlsites_batch(self):
+        manifest = get_temp_file_name(extension='.tsv')
+        with open(manifest, 'wt') as handle:
+            for _ in range(2):
+                handle.write('\t'.join([
+                    self.bam,
+                    get_temp_file_name(extension='.bed'),
+                    get_temp_file_name(extension='.bed'),
+                    get_temp_file_name(extension='.bam'),
+                ]) + '\n')
+
+        command_basic = [
+            'iCount', 'xlsites_batch', manifest,
+            '-S', '40',  # Supress lower than ERROR messages.
+        ]
+        command_full = [
+            'iCount', 'xlsites_batch', manifest,
+            '--group_by', 'start',
+            '--quant', 'cDNA',
+            '--mismatches', '2',
+            '--mapq_th', '0',
+            '--multimax', '50',
+            '--gap_th', '4',
+            '--ratio_th', '0.1',
+            '--max_barcodes', '10000',
+            '--processes', '2',
+            '-S', '40',  # Supress lower than ERROR messages.
+        ]
+
+        self.assertEqual(subprocess.call(command_basic), 0)
+        self.assertEqual(subprocess.call(command_full), 0)
+
+    def test_xlsites_update(self):
+        unique = get_temp_file_name(extension='.bed')
+        multi = get_temp_file_name(extension='.bed')
+        strange = get_temp_file_name(extension='.bam')
+        state = get_temp_file_name(extension='.pkl')
+        command_run = [
+            'iCount', 'xlsites', self.bam, unique, multi, strange,
+            '--state', state,
+            '-S', '40',  # Supress lower than ERROR messages.
+        ]
+        command_update = [
+            'iCount', 'xlsites_update', state, unique, multi, strange,
+            self.bam, self.bam,
+            '--quant', 'reads',
+            '-S', '40',  # Supress lower than ERROR messages.
+        ]
+
+        self.assertEqual(subprocess.call(command_run), 0)
+        self.assertEqual(subprocess.call(command_update), 0)
+
     # #################################
     # #################################
 
@@ -373,6 +425,8 @@ class TestCLI(unittest.TestCase):
             '--rnd_seed', '42',
             '--features', 'gene',
             '--report_progress',
+            '--processes', '2',
+            '--background', 'auto',
             '-S', '40',  # Supress lower than ERROR messages.
         ]
 
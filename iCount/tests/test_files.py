@@ -6,8 +6,11 @@ import unittest
 import tempfile
 import warnings
 
+import pysam
+
 import iCount
-from iCount.tests.utils import get_temp_file_name, make_file_from_list, make_list_from_file
+from iCount.tests.utils import get_temp_file_name, make_bam_file, make_file_from_list, \
+    make_list_from_file
 
 
 class TestFilesTemp(unittest.TestCase):
@@ -49,6 +52,50 @@ class TestFilesTemp(unittest.TestCase):
         os.rmdir(self.tempdir)
 
 
+class TestFilesBam(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+        self.bam_fname = make_bam_file({
+            'chromosomes': [('chr1', 3000)],
+            'segments': [
+                ('_:rbc:AAA', 0, 0, 500, 255, [(0, 100)], {'NH': 1}),
+                ('_:rbc:CCC', 0, 0, 50, 255, [(0, 100)], {'NH': 1}),
+            ],
+        }, rnd_seed=0)
+        self.sorted_fname = get_temp_file_name(extension='bam')
+        pysam.sort('-o', self.sorted_fname, self.bam_fname)  # pylint: disable=no-member
+
+    def test_unsorted(self):
+        bam_fname, index, tmp_files = iCount.files.bam.ensure_sorted_indexed(self.bam_fname)
+        self.assertNotEqual(bam_fname, self.bam_fname)
+        self.assertEqual(tmp_files, [bam_fname, index])
+        with pysam.AlignmentFile(bam_fname, index_filename=index) as bamfile:
+            self.assertEqual([read.reference_start for read in bamfile.fetch('chr1')], [50, 500])
+
+    def test_sorted_no_index(self):
+        bam_fname, index, tmp_files = iCount.files.bam.ensure_sorted_indexed(self.sorted_fname)
+        self.assertEqual(bam_fname, self.sorted_fname)
+        self.assertEqual(tmp_files, [index])
+        self.assertTrue(os.path.isfile(index))
+
+    def test_sorted_indexed(self):
+        pysam.index(self.sorted_fname)  # pylint: disable=no-member
+        bam_fname, index, tmp_files = iCount.files.bam.ensure_sorted_indexed(self.sorted_fname)
+        self.assertEqual(bam_fname, self.sorted_fname)
+        self.assertEqual(index, self.sorted_fname + '.bai')
+        self.assertEqual(tmp_files, [])
+
+    def test_sorted_stale_index(self):
+        pysam.index(self.sorted_fname)  # pylint: disable=no-member
+        mtime = os.path.getmtime(self.sorted_fname)
+        os.utime(self.sorted_fname + '.bai', (mtime - 10, mtime - 10))
+        bam_fname, index, tmp_files = iCount.files.bam.ensure_sorted_indexed(self.sorted_fname)
+        self.assertEqual(bam_fname, self.sorted_fname)
+        self.assertNotEqual(index, self.sorted_fname + '.bai')
+        self.assertEqual(tmp_files, [index])
+
+
 class TestFilesFastq(unittest.TestCase):
 
     def setUp(self):
@@ -1,13 +1,23 @@
 # pylint: disable=missing-docstring, protected-access
 
+import os
+import functools
 import unittest
 import warnings
+from collections import Counter
 
+import numpy
+
+import iCount
 from iCount.analysis import peaks
 from iCount.tests.utils import get_temp_file_name, make_file_from_list, \
     make_list_from_file
 
 
+def _draw(_):
+    return tuple(numpy.random.randint(10 ** 9, size=5))
+
+
 class TestPeaks(unittest.TestCase):
 
     def setUp(self):
@@ -79,6 +89,182 @@ class TestPeaks(unittest.TestCase):
         for res, exp, in zip(result, expected):
             self.assertAlmostEqual(res, exp, delta=0.02)
 
+    def test_rnd_cumulative_probs(self):
+        size, total_hits, half_window, perms = 100, 30, 3, 50
+
+        # Same as computing cumulative_prob for each permutation separately:
+        numpy.random.seed(0)
+        expected = []
+        for _ in range(perms):
+            rnd_hits = Counter(numpy.random.randint(size, size=total_hits))
+            scores_sww = peaks._sum_within_window_nopos(rnd_hits.items(), half_window=half_window)
+            expected.append(peaks.cumulative_prob(scores_sww, total_hits))
+
+        numpy.random.seed(0)
+        result = peaks._rnd_cumulative_probs(size, total_hits, half_window, perms)
+        numpy.testing.assert_array_equal(result, expected)
+
+    def test_get_avg_rnd_distrib_blocks(self):
+        size, total_hits, half_window, perms = 100, 30, 3, 50
+
+        numpy.random.seed(0)
+        rnd_ps = peaks._rnd_cumulative_probs(size, total_hits, half_window, perms)
+        expected = numpy.minimum(1.0, numpy.mean(rnd_ps, axis=0) + numpy.std(rnd_ps, axis=0))
+
+        # Blocks of 3 permutations, last block has only 2:
+        block_size = peaks.PERMS_BLOCK_SIZE
+        peaks.PERMS_BLOCK_SIZE = 3 * (total_hits + 1)
+        peaks.get_avg_rnd_distrib.cache_clear()
+        try:
+            numpy.random.seed(0)
+            result = peaks.get_avg_rnd_distrib(size, total_hits, half_window, perms=perms)
+        finally:
+            peaks.PERMS_BLOCK_SIZE = block_size
+            peaks.get_avg_rnd_distrib.cache_clear()
+
+        numpy.testing.assert_allclose(result, expected)
+
+    def test_get_avg_rnd_distrib_seed(self):
+        size, total_hits, half_window, perms = 100, 30, 3, 50
+
+        tmp_root = iCount.TMP_ROOT
+        iCount.TMP_ROOT = get_temp_file_name()
+        try:
+            numpy.random.seed(0)
+            result = peaks.get_avg_rnd_distrib(size, total_hits, half_window, perms, rnd_seed=7)
+            self.assertIs(result, peaks.get_avg_rnd_distrib(
+                size, total_hits, half_window, perms, rnd_seed=7))
+            # Disk cache is not used by default:
+            fname = peaks._background_fname(size, total_hits, half_window, perms, 7)
+            self.assertFalse(os.path.exists(fname))
+
+            disk = peaks.get_avg_rnd_distrib(size, total_hits, half_window, perms, rnd_seed=7,
+                                             disk_cache=True)
+            numpy.testing.assert_array_equal(disk, result)
+            numpy.testing.assert_array_equal(numpy.load(fname), result)
+
+            # Distribution is read from disk after it is evicted from memory:
+            peaks.get_avg_rnd_distrib.cache_clear()
+            numpy.testing.assert_array_equal(
+                peaks.get_avg_rnd_distrib(size, total_hits, half_window, perms, rnd_seed=7,
+                                          disk_cache=True),
+                result)
+
+            # Seeded distribution does not depend on the global random generator:
+            peaks.get_avg_rnd_distrib.cache_clear()
+            numpy.random.seed(1)
+            numpy.testing.assert_array_equal(
+                peaks.get_avg_rnd_distrib(size, total_hits, half_window, perms, rnd_seed=7),
+                result)
+
+            other = peaks.get_avg_rnd_distrib(size, total_hits, half_window, perms, rnd_seed=8)
+            self.assertFalse(numpy.array_equal(other, result))
+        finally:
+            iCount.TMP_ROOT = tmp_root
+            peaks.get_avg_rnd_distrib.cache_clear()
+
+    def test_cache_bytes(self):
+        cache_bytes = peaks.PS_CACHE_BYTES
+        # Room for two distributions with 30 hits:
+        peaks.PS_CACHE_BYTES = 2 * 31 * 8
+        peaks.get_analytic_distrib.cache_clear()
+        try:
+            first = peaks.get_analytic_distrib(100, 30, 3)
+            second = peaks.get_analytic_distrib(200, 30, 3)
+            self.assertIs(peaks.get_analytic_distrib(100, 30, 3), first)
+            # The least recently used distribution is dropped:
+            peaks.get_analytic_distrib(300, 30, 3)
+            self.assertIs(peaks.get_analytic_distrib(100, 30, 3), first)
+            self.assertIsNot(peaks.get_analytic_distrib(200, 30, 3), second)
+            # Distribution larger than the whole cache is not kept:
+            large = peaks.get_analytic_distrib(100, 100, 3)
+            self.assertIsNot(peaks.get_analytic_distrib(100, 100, 3), large)
+        finally:
+            peaks.PS_CACHE_BYTES = cache_bytes
+            peaks.get_analytic_distrib.cache_clear()
+
+    def test_distributions(self):
+        numpy.testing.assert_allclose(peaks._binom_tail(3, 0.5, 5), [1., 0.875, 0.5, 0.125, 0.])
+        numpy.testing.assert_allclose(peaks._binom_tail(3, 1., 5), [1., 1., 1., 1., 0.])
+        numpy.testing.assert_allclose(peaks._poisson_pmf(0, 3), [1., 0., 0.])
+        pmf = peaks._poisson_pmf(1.5, 4)
+        self.assertAlmostEqual(pmf.sum(), 1.)
+        numpy.testing.assert_allclose(
+            peaks._convolve(pmf, pmf), peaks._poisson_pmf(3., 4), atol=1e-12)
+        numpy.testing.assert_allclose(
+            peaks._min_pmf(peaks._tail(numpy.array([0.5, 0.5]))), [0.75, 0.25])
+
+    def test_get_analytic_distrib(self):
+        # Agrees with permutations on large group:
+        size, total_hits, half_window = 2000, 300, 3
+        numpy.random.seed(0)
+        rnd_ps = peaks._rnd_cumulative_probs(size, total_hits, half_window, 2000)
+        expected = numpy.minimum(1.0, numpy.mean(rnd_ps, axis=0) + numpy.std(rnd_ps, axis=0))
+        result = peaks.get_analytic_distrib(size, total_hits, half_window)
+        self.assertEqual(result.shape, expected.shape)
+        numpy.testing.assert_allclose(result, expected, atol=0.005)
+
+        # Larger half-window needs larger group, as used in 'auto' mode:
+        size, total_hits, half_window = 300, 300, 10
+        numpy.random.seed(0)
+        rnd_ps = peaks._rnd_cumulative_probs(size, total_hits, half_window, 2000)
+        expected = numpy.minimum(1.0, numpy.mean(rnd_ps, axis=0) + numpy.std(rnd_ps, axis=0))
+        numpy.testing.assert_allclose(
+            peaks.get_analytic_distrib(size, total_hits, half_window), expected, atol=0.01)
+
+        # All hits on a single position:
+        numpy.testing.assert_allclose(peaks.get_analytic_distrib(1, 3, 2), [1., 1., 1., 1.])
+
+        # Tail is non-increasing also on small groups:
+        for size, total_hits, half_window in [(20, 30, 10), (11, 8, 3), (5, 50, 1)]:
+            result = peaks.get_analytic_distrib(size, total_hits, half_window)
+            self.assertTrue(numpy.all(numpy.diff(result) <= 0))
+
+    def test_process_group_background(self):
+        pos_scores = [(14, 3.), (16, 5.)]
+        permutation = list(peaks._process_group(pos_scores, 11, 3, 20, rnd_seed=42))
+        analytic = list(peaks._process_group(pos_scores, 11, 3, 20, background='analytic'))
+        self.assertNotEqual(permutation, analytic)
+        self.assertEqual([fdr for _, _, _, fdr in analytic], [
+            min(1.0, peaks.get_analytic_distrib(11, 8, 3)[8] / 1.0)] * 2)
+        # Group is too small for analytic background in 'auto' mode:
+        self.assertEqual(
+            list(peaks._process_group(pos_scores, 11, 3, 20, rnd_seed=42, background='auto')),
+            permutation)
+
+        # Minimal group size in 'auto' mode grows with half-window:
+        pos_scores = [(pos, 1.) for pos in range(100)]
+        for half_window, size, is_analytic in [(3, 100, True), (10, 200, False), (10, 300, True)]:
+            analytic = list(peaks._process_group(pos_scores, size, half_window, 20,
+                                                 background='analytic'))
+            auto = list(peaks._process_group(pos_scores, size, half_window, 20, rnd_seed=42,
+                                             background='auto'))
+            self.assertEqual(auto == analytic, is_analytic)
+
+    def test_process_groups(self):
+        tasks = [
+            [(('1', '+', 'g1', 'A'), [(14, 3.), (16, 5.)], 11),
+             (('1', '+', 'g2', 'B'), [(34, 4.), (36, 4.)], 11)],
+            [(('2', '+', 'g3', 'C'), [(10, 1.), (15, 1.), (40, 1.)], 50)],
+        ]
+        worker = functools.partial(peaks._process_groups, half_window=3, perms=20, rnd_seed=42)
+
+        serial = list(peaks._map_tasks(worker, tasks, processes=1))
+        self.assertEqual(serial[0][0], (('1', '+', 'g1', 'A'), list(peaks._process_group(
+            [(14, 3.), (16, 5.)], 11, 3, 20, rnd_seed=42))))
+        self.assertEqual([group for processed in serial for group, _ in processed],
+                         [('1', '+', 'g1', 'A'), ('1', '+', 'g2', 'B'), ('2', '+', 'g3', 'C')])
+
+        # Results do not depend on the number of processes:
+        parallel = list(peaks._map_tasks(worker, tasks, processes=2))
+        self.assertEqual(sorted(parallel), sorted(serial))
+
+    def test_map_tasks_random(self):
+        # Worker processes do not share the state of global random generator:
+        numpy.random.seed(42)
+        draws = list(peaks._map_tasks(_draw, range(20), processes=2))
+        self.assertEqual(len(set(draws)), 20)
+
     def test_run(self):
         fin_annotation = make_file_from_list([
             ['1', '.', 'gene', '10', '20', '.', '+', '.', 'gene_name "A"; gene_id "1";'],
@@ -95,8 +281,7 @@ class TestPeaks(unittest.TestCase):
         fout_peaks = get_temp_file_name(extension='.bed.gz')
         fout_scores = get_temp_file_name(extension='.tsv.gz')
 
-        peaks.run(fin_annotation, fin_sites, fout_peaks,
-                  scores=fout_scores)
+        peaks.run(fin_annotation, fin_sites, fout_peaks, scores=fout_scores, fdr=0.1)
 
         out_peaks = make_list_from_file(fout_peaks, fields_separator='\t')
         out_scores = make_list_from_file(fout_scores, fields_separator='\t')
@@ -108,14 +293,64 @@ class TestPeaks(unittest.TestCase):
             ['1', '16', '17', 'A-1', '5', '+'],
         ]
         expected_scores = [
-            ['1', '14', '+', 'A', '1', '3', '8', '0.036198'],
-            ['1', '16', '+', 'A', '1', '5', '8', '0.036198'],
+            ['1', '14', '+', 'A', '1', '3', '8', '0.071801'],
+            ['1', '16', '+', 'A', '1', '5', '8', '0.071801'],
             ['2', '16', '+', 'not_annotated', 'not_annotated', '5', 'not_calculated', '1'],
         ]
 
         self.assertEqual(out_peaks, expected_peaks)
         self.assertEqual(out_scores, expected_scores)
 
+    def test_run_processes(self):
+        fin_annotation = make_file_from_list([
+            ['1', '.', 'gene', '10', '20', '.', '+', '.', 'gene_name "A"; gene_id "1";'],
+            ['2', '.', 'gene', '10', '20', '.', '+', '.', 'gene_name "B"; gene_id "2";'],
+        ])
+
+        fin_sites = make_file_from_list([
+            ['1', '14', '15', '.', '3', '+'],
+            ['1', '16', '17', '.', '5', '+'],
+            ['2', '16', '17', '.', '5', '+'],
+        ])
+
+        fout_peaks = get_temp_file_name(extension='.bed.gz')
+        fout_scores = get_temp_file_name(extension='.tsv.gz')
+
+        # Each distribution has its own random generator, so results do not
+        # depend on the number of processes:
+        expected_scores = [
+            ['1', '14', '+', 'A', '1', '3', '8', '0.071801'],
+            ['1', '16', '+', 'A', '1', '5', '8', '0.071801'],
+            ['2', '16', '+', 'B', '2', '5', '5', '0.256772'],
+        ]
+        expected_peaks = [
+            ['1', '14', '15', 'A-1', '3', '+'],
+            ['1', '16', '17', 'A-1', '5', '+'],
+        ]
+        for processes in [1, 2]:
+            peaks.run(fin_annotation, fin_sites, fout_peaks, scores=fout_scores, fdr=0.1,
+                      processes=processes)
+            self.assertEqual(make_list_from_file(fout_peaks, fields_separator='\t'), expected_peaks)
+            self.assertEqual(make_list_from_file(fout_scores, fields_separator='\t')[1:],
+                             expected_scores)
+
+        # Disk cache uses the same random generators, whether distributions
+        # are computed or read from disk:
+        tmp_root = iCount.TMP_ROOT
+        iCount.TMP_ROOT = get_temp_file_name()
+        try:
+            for _ in range(2):
+                peaks.get_avg_rnd_distrib.cache_clear()
+                peaks.run(fin_annotation, fin_sites, fout_peaks, scores=fout_scores, fdr=0.1,
+                          disk_cache=True)
+                self.assertTrue(os.path.isdir(os.path.join(iCount.TMP_ROOT, 'peaks')))
+                self.assertEqual(make_list_from_file(fout_peaks, fields_separator='\t'),
+                                 expected_peaks)
+                self.assertEqual(make_list_from_file(fout_scores, fields_separator='\t')[1:],
+                                 expected_scores)
+        finally:
+            iCount.TMP_ROOT = tmp_root
+
 
 if __name__ == '__main__':
     unittest.main()
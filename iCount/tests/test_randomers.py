@@ -0,0 +1,362 @@
+# pylint: disable=missing-docstring, protected-access
+
+import copy
+import random
+import warnings
+import unittest
+from unittest import mock
+
+import numpy
+import pysam
+
+from iCount.mapping import randomers
+
+
+class TestHits(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_list_like(self):
+        hits = randomers._Hits([(5, 10, 10, 1, 0)])
+        hits.append((6, 30, 20, 2, 25))
+        self.assertEqual(len(hits), 2)
+        self.assertEqual(hits[1], (6, 30, 20, 2, 25))
+        self.assertEqual(list(hits), [(5, 10, 10, 1, 0), (6, 30, 20, 2, 25)])
+
+        other = randomers._Hits([(7, 12, 12, 5, 0)])
+        other.extend(hits)
+        other.extend([(8, 9, 1, 1, 0)])
+        self.assertEqual(other, [(7, 12, 12, 5, 0), (5, 10, 10, 1, 0), (6, 30, 20, 2, 25), (8, 9, 1, 1, 0)])
+
+    def test_compare(self):
+        hits = randomers._Hits([(5, 10, 10, 1, 0), (6, 30, 20, 2, 25)])
+        self.assertTrue(hits == randomers._Hits([(5, 10, 10, 1, 0), (6, 30, 20, 2, 25)]))
+        self.assertFalse(hits != [(5, 10, 10, 1, 0), (6, 30, 20, 2, 25)])
+        self.assertTrue(hits != randomers._Hits([(5, 10, 10, 1, 0)]))
+        self.assertTrue(hits != [5, 10, 10, 1, 0, 6, 30, 20, 2, 25])
+        self.assertNotEqual(hits, 'hits')
+
+    def test_copy(self):
+        hits = randomers._Hits([(5, 10, 10, 1, 0)])
+        for copied in [copy.copy(hits), copy.deepcopy(hits)]:
+            self.assertIsInstance(copied, randomers._Hits)
+            self.assertEqual(copied, hits)
+            copied.append((6, 30, 20, 2, 25))
+            self.assertEqual(len(copied), 2)
+            self.assertEqual(len(hits), 1)
+
+    def test_slice(self):
+        hits = randomers._Hits([(5, 10, 10, 1, 0), (6, 30, 20, 2, 25), (7, 12, 12, 5, 0)])
+        self.assertIsInstance(hits[0:1], randomers._Hits)
+        self.assertEqual(hits[0:1], [(5, 10, 10, 1, 0)])
+        self.assertEqual(hits[::-2], [(7, 12, 12, 5, 0), (5, 10, 10, 1, 0)])
+        self.assertEqual(hits[-1], (7, 12, 12, 5, 0))
+        with self.assertRaises(IndexError):
+            hits[3]  # pylint: disable=pointless-statement
+
+    def test_hit_tuples(self):
+        hits = randomers._Hits([(5, 10, 10, 1, 0), (6, 30, 20, 2, 25)])
+        self.assertIn((6, 30, 20, 2, 25), hits)
+        self.assertNotIn(5, hits)
+        self.assertEqual(randomers._Hits.frombytes(hits.tobytes()), hits)
+        self.assertFalse(hasattr(hits, 'pop'))
+
+
+class TestBarcodeCounter(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_exact(self):
+        barcodes = ['AAA', 'CCC', 'AAA', 'GGG', 'AAA', 'CCC']
+        for capacity in [0, 3]:
+            counter = randomers._BarcodeCounter(capacity)
+            for barcode in barcodes:
+                counter.add(barcode)
+            self.assertEqual(counter, {'AAA': 3, 'CCC': 2, 'GGG': 1})
+            self.assertEqual(counter.most_common(2), [(3, 'AAA'), (2, 'CCC')])
+
+    def test_heavy_hitters(self):
+        random.seed(42)
+        barcodes = ['AAA'] * 300 + ['CCC'] * 200 + [str(i) for i in range(1000)]
+        random.shuffle(barcodes)
+        counter = randomers._BarcodeCounter(20)
+        for barcode in barcodes:
+            counter.add(barcode)
+
+        self.assertEqual(len(counter), 20)
+        (count1, barcode1), (count2, barcode2) = counter.most_common(2)
+        self.assertEqual((barcode1, barcode2), ('AAA', 'CCC'))
+        # Counts are overestimated by at most number of records / capacity:
+        self.assertTrue(300 <= count1 <= 300 + len(barcodes) / 20)
+        self.assertTrue(200 <= count2 <= 200 + len(barcodes) / 20)
+
+    def test_merge(self):
+        counter1 = randomers._BarcodeCounter(2)
+        for barcode in ['AAA', 'AAA', 'AAA', 'CCC']:
+            counter1.add(barcode)
+        counter2 = randomers._BarcodeCounter(2)
+        for barcode in ['GGG', 'CCC', 'GGG', 'CCC']:
+            counter2.add(barcode)
+        counter1.merge(counter2)
+        self.assertEqual(counter1, {'AAA': 3, 'CCC': 3})
+
+        counter1.add('AAA')
+        counter1.add('TTT')
+        self.assertEqual(counter1, {'AAA': 4, 'TTT': 4})
+
+
+class TestGetRandomBarcode(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_good_name(self):
+        name = randomers._get_random_barcode('_____:rbc:AAA:____', mock.MagicMock())
+        self.assertEqual(name, 'AAA')
+
+    def test_no_rbc_key_valid_nucs(self):
+        metrics = mock.MagicMock()
+        name = randomers._get_random_barcode('_____:AAA', metrics)
+        self.assertEqual(name, 'AAA')
+
+    def test_no_rbc_key_invalid_nucs(self):
+        metrics = mock.MagicMock()
+        metrics.invalidrandomer_recs = 0
+        name = randomers._get_random_barcode('_____:AAB', metrics)
+        self.assertEqual(name, '')
+        self.assertEqual(metrics.invalidrandomer_recs, 1)
+
+    def test_bad_name(self):
+        metrics = mock.MagicMock()
+        metrics.norandomer_recs = 0
+        name = randomers._get_random_barcode('blah', metrics)
+        self.assertEqual(name, '')
+        self.assertEqual(metrics.norandomer_recs, 1)
+
+    def test_last_rbc_key(self):
+        name = randomers._get_random_barcode('_:rbc:AAA:rbc:CCN/1', mock.MagicMock())
+        self.assertEqual(name, 'CCN')
+
+        # Last key is not followed by randomer:
+        name = randomers._get_random_barcode('_:rbc:AAA:rbc:_', mock.MagicMock())
+        self.assertEqual(name, 'AAA')
+
+
+class TestGetTagBarcode(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = mock.MagicMock()
+        self.metrics.norandomer_recs = 0
+        self.metrics.invalidrandomer_recs = 0
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_tag(self):
+        read = pysam.AlignedSegment()
+        read.set_tag('RX', 'ACGTN')
+        self.assertEqual(randomers._get_tag_barcode(read, 'RX', self.metrics), 'ACGTN')
+
+    def test_no_tag(self):
+        read = pysam.AlignedSegment()
+        self.assertEqual(randomers._get_tag_barcode(read, 'RX', self.metrics), '')
+        self.assertEqual(self.metrics.norandomer_recs, 1)
+
+    def test_invalid_tag(self):
+        read = pysam.AlignedSegment()
+        read.set_tag('RX', 'AC-GT')
+        self.assertEqual(randomers._get_tag_barcode(read, 'RX', self.metrics), '')
+        self.assertEqual(self.metrics.invalidrandomer_recs, 1)
+
+
+class TestMatch(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_match_basic(self):
+        self.assertFalse(randomers._match('ACGT', 'ACGG', 0))
+        self.assertTrue(randomers._match('ACGT', 'ACGG', 1))
+
+    def test_match_unequal_len(self):
+        self.assertFalse(randomers._match('AAAAA', 'AGNN', 1))
+        self.assertTrue(randomers._match('AGNN', 'AAAAA', 2))
+
+    def test_capital_letters(self):
+        self.assertTrue(randomers._match('AAAA', 'aaaa', 0))
+        self.assertTrue(randomers._match('AAAA', 'anna', 0))
+        self.assertFalse(randomers._match('AAAG', 'aaaa', 0))
+        self.assertTrue(randomers._match('AAAG', 'aaaa', 1))
+        self.assertTrue(randomers._match('AANG', 'aaaa', 1))
+
+        self.assertFalse(randomers._match('AACGG', 'NAAAN', 1))
+
+
+class TestCountMismatches(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_same_as_match(self):
+        barcodes = ['AAAAA', 'AAAAG', 'NAAAN', 'TTTTN', 'AAAA', 'aaaag', 'GGGGGG']
+        encoded = randomers._encode_randomers(barcodes)
+        others = numpy.arange(len(barcodes))
+        for index, barcode in enumerate(barcodes):
+            mismatches = randomers._count_mismatches(encoded, index, others)
+            for other, count in zip(barcodes, mismatches):
+                self.assertTrue(randomers._match(barcode, other, count))
+                self.assertFalse(randomers._match(barcode, other, count - 1))
+
+    def test_not_encodable(self):
+        self.assertIsNone(randomers._encode_randomers(['AAAAA', 'AAXAA']))
+        self.assertIsNone(randomers._encode_randomers(['A' * 33]))
+
+
+class TestMergeSimilarRandomers(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_merge(self):
+        # hit1, hit2, ... should all be a 4-tuple, but for this test it is ok as is
+        by_bc = {
+            'AAAAA': ['hit1', 'hit2'],
+            'AAAAG': ['hit3'],
+            'TTTTN': ['hit42'],
+            'GGGGG': ['hit4', 'hit5'],
+            'NAAAN': ['hit6'],
+        }
+        expected = {
+            'GGGGG': ['hit4', 'hit5'],
+            'AAAAA': ['hit1', 'hit2', 'hit6'],
+            'AAAAG': ['hit3'],
+            'TTTTN': ['hit42'],
+        }
+        randomers._merge_similar_randomers(by_bc, mismatches=2, max_barcodes=10000, ratio_th=0.1)  # 1/10
+        self.assertEqual(by_bc, expected)
+
+    def test_merge_ratio_th(self):
+        # hit1, hit2, ... should all be a 4-tuple, but for this test it is ok as is
+        by_bc = {
+            'AAAAA': ['hit1', 'hit2', 'hit4', 'hit5', 'hit6'],
+            'GGGGG': ['hit7', 'hit8'],
+            'GGGGC': ['hit14', 'hit15'],
+            'GGGGA': ['hit9'],
+            'AAAAG': ['hit10'],
+            'GAAAG': ['hit11'],
+            'CCCCC': ['hit12'],
+            'CCCCG': ['hit13'],
+        }
+        expected = {
+            'AAAAA': ['hit1', 'hit2', 'hit4', 'hit5', 'hit6', 'hit10'],
+            'GGGGG': ['hit7', 'hit8', 'hit9'],
+            'GGGGC': ['hit14', 'hit15'],
+            'GAAAG': ['hit11'],
+            'CCCCG': ['hit13', 'hit12'],
+        }
+        randomers._merge_similar_randomers(by_bc, mismatches=1, max_barcodes=10000, ratio_th=0.4)  # 2/5
+        self.assertEqual(by_bc, expected)
+
+    def test_max_barcodes(self):
+        # hit1, hit2, ... should all be a 4-tuple, but for this test it is ok as is
+        by_bc = {
+            'AAAAA': ['hit1', 'hit2', 'hit3', 'hit4'],
+            'AAAAG': ['hit5', 'hit6'],
+            'AAAAT': ['hit7'],
+        }
+        expected_max_barcodes_1 = {
+            'AAAAA': ['hit1', 'hit2', 'hit3', 'hit4'],
+            'AAAAG': ['hit5', 'hit6'],
+            'AAAAT': ['hit7'],
+        }
+        randomers._merge_similar_randomers(by_bc, mismatches=2, max_barcodes=1, ratio_th=0.5)
+        self.assertEqual(by_bc, expected_max_barcodes_1)
+
+        expected_max_barcodes_10 = {
+            'AAAAA': ['hit1', 'hit2', 'hit3', 'hit4', 'hit7'],
+            'AAAAG': ['hit5', 'hit6'],
+        }
+        randomers._merge_similar_randomers(by_bc, mismatches=2, max_barcodes=10, ratio_th=0.5)
+        self.assertEqual(by_bc, expected_max_barcodes_10)
+
+    def test_vectorized(self):
+        random.seed(42)
+        by_bc = {}
+        for i in range(200):
+            barcode = ''.join(random.choice('ACGTN' if random.random() < 0.2 else 'ACGT')
+                              for _ in range(random.choice([4, 5, 5, 5, 6])))
+            by_bc.setdefault(barcode, []).extend(['hit{}'.format(i)] * random.choice([1, 1, 2, 10]))
+        by_bc_vectorized = copy.deepcopy(by_bc)
+
+        with mock.patch('iCount.mapping.randomers.VECTORIZE_MIN_BARCODES', 10 ** 6):
+            randomers._merge_similar_randomers(by_bc, mismatches=1, max_barcodes=10000)
+        with mock.patch('iCount.mapping.randomers.VECTORIZE_MIN_BARCODES', 1):
+            randomers._merge_similar_randomers(by_bc_vectorized, mismatches=1, max_barcodes=10000)
+        self.assertEqual(by_bc, by_bc_vectorized)
+
+    def test_directional(self):
+        # hit1, hit2, ... should all be a 4-tuple, but for this test it is ok as is
+        by_bc = {
+            'AAAAA': ['hit1', 'hit2', 'hit3', 'hit4', 'hit5'],
+            'AAAAT': ['hit6', 'hit7'],
+            'AAATT': ['hit8'],
+            'CCCCC': ['hit9', 'hit10'],
+            'CCCCG': ['hit11', 'hit12'],
+            'GGGGG': ['hit13'],
+            'GGGNN': ['hit14'],
+        }
+        expected = {
+            # AAAAT (2 reads) is merged to AAAAA (5 reads) and AAATT (1 read)
+            # to AAAAT, although it differs from AAAAA in two positions:
+            'AAAAA': ['hit1', 'hit2', 'hit3', 'hit4', 'hit5', 'hit6', 'hit7', 'hit8'],
+            # Randomers with the same count are not merged:
+            'CCCCC': ['hit9', 'hit10'],
+            'CCCCG': ['hit11', 'hit12'],
+            'GGGGG': ['hit13', 'hit14'],
+        }
+        randomers._merge_similar_randomers(
+            by_bc, mismatches=1, max_barcodes=0, ratio_th=0.1, umi_method='directional')
+        self.assertEqual(by_bc, expected)
+
+    def test_directional_no_mismatches(self):
+        by_bc = {
+            'AAAA': ['hit{}'.format(i) for i in range(10)],
+            'AAAT': ['hit10'],
+        }
+        expected = {key: list(value) for key, value in by_bc.items()}
+        randomers._merge_similar_randomers(
+            by_bc, mismatches=0, max_barcodes=0, ratio_th=0.1, umi_method='directional')
+        self.assertEqual(by_bc, expected)
+
+    def test_neighbours(self):
+        self.assertEqual(list(randomers._neighbours('AC', 0)), [])
+        self.assertEqual(sorted(randomers._neighbours('AC', 1)), ['AA', 'AG', 'AT', 'CC', 'GC', 'TC'])
+        neighbours = list(randomers._neighbours('ACGTA', 2))
+        self.assertEqual(len(neighbours), len(set(neighbours)))
+        self.assertEqual(len(neighbours), 5 * 3 + 10 * 3 * 3)
+        self.assertTrue(all(randomers._match('ACGTA', other, 2) for other in neighbours))
+
+    @unittest.skip
+    def test_todo(self):
+        """
+        This test fails since we currently do not support the feature of finding
+        the most similar match. Rather than that, we accept the first match even
+        though better one is available.
+        """
+
+        # hit1, hit2, should be a 4-tuple, but for this test it is ok as is
+        by_bc = {
+            'AAAAA': ['hit1'],
+            'AACGG': ['hit2', 'hit3'],
+            'NAAAN': ['hit4'],
+        }
+        randomers._merge_similar_randomers(by_bc, mismatches=2, max_barcodes=10000)
+        expected = {
+            'AACGG': ['hit2', 'hit3'],
+            'AAAAA': ['hit1', 'hit4'],
+        }
+        self.assertEqual(by_bc, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
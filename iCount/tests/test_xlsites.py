@@ -1,307 +1,65 @@
 # pylint: disable=missing-docstring, protected-access
 
+import json
+import os
+import pickle
+import threading
 import warnings
+import zlib
 import unittest
 from unittest import mock
 
-import pybedtools
+import pysam
 
-from iCount.mapping import xlsites
-from iCount.tests.utils import get_temp_file_name, make_bam_file
+from iCount.files import bam
+from iCount.mapping import xlsites, xlsites_checkpoint, xlsites_common, xlsites_state
+from iCount.tests.utils import get_temp_dir, get_temp_file_name, make_bam_file, make_fasta_file, \
+    make_file_from_list
 
 
-class TestGetRandomBarcode(unittest.TestCase):
+class TestLoadSegmentBorders(unittest.TestCase):
 
     def setUp(self):
         warnings.simplefilter("ignore", ResourceWarning)
 
-    def test_good_name(self):
-        name = xlsites._get_random_barcode('_____:rbc:AAA:____', mock.MagicMock())
-        self.assertEqual(name, 'AAA')
-
-    def test_no_rbc_key_valid_nucs(self):
-        metrics = mock.MagicMock()
-        name = xlsites._get_random_barcode('_____:AAA', metrics)
-        self.assertEqual(name, 'AAA')
-
-    def test_no_rbc_key_invalid_nucs(self):
-        metrics = mock.MagicMock()
-        metrics.invalidrandomer_recs = 0
-        name = xlsites._get_random_barcode('_____:AAB', metrics)
-        self.assertEqual(name, '')
-        self.assertEqual(metrics.invalidrandomer_recs, 1)
-
-    def test_bad_name(self):
-        metrics = mock.MagicMock()
-        metrics.norandomer_recs = 0
-        name = xlsites._get_random_barcode('blah', metrics)
-        self.assertEqual(name, '')
-        self.assertEqual(metrics.norandomer_recs, 1)
-
-
-class TestMatch(unittest.TestCase):
-
-    def setUp(self):
-        warnings.simplefilter("ignore", ResourceWarning)
-
-    def test_match_basic(self):
-        self.assertFalse(xlsites._match('ACGT', 'ACGG', 0))
-        self.assertTrue(xlsites._match('ACGT', 'ACGG', 1))
-
-    def test_match_unequal_len(self):
-        self.assertFalse(xlsites._match('AAAAA', 'AGNN', 1))
-        self.assertTrue(xlsites._match('AGNN', 'AAAAA', 2))
-
-    def test_capital_letters(self):
-        self.assertTrue(xlsites._match('AAAA', 'aaaa', 0))
-        self.assertTrue(xlsites._match('AAAA', 'anna', 0))
-        self.assertFalse(xlsites._match('AAAG', 'aaaa', 0))
-        self.assertTrue(xlsites._match('AAAG', 'aaaa', 1))
-        self.assertTrue(xlsites._match('AANG', 'aaaa', 1))
-
-        self.assertFalse(xlsites._match('AACGG', 'NAAAN', 1))
-
-
-class TestUpdate(unittest.TestCase):
-
-    def setUp(self):
-        warnings.simplefilter("ignore", ResourceWarning)
-
-    def test_match_basic(self):
-        cur_vals = {
-            'A': [1, 2, 3],
-            'B': [4, 5, 0],
-        }
-        to_add = {
-            'A': [1, 0, 1],
-            'C': [42, 2, 3],
-        }
-
-        expected = {
-            'A': [2, 2, 4],
-            'B': [4, 5, 0],
-            'C': [42, 2, 3],
-        }
-        xlsites._update(cur_vals, to_add)
-        self.assertEqual(expected, cur_vals)
-
-
-class TestMergeSimilarRandomers(unittest.TestCase):
-
-    def setUp(self):
-        warnings.simplefilter("ignore", ResourceWarning)
-
-    def test_merge(self):
-        # hit1, hit2, ... should all be a 4-tuple, but for this test it is ok as is
-        by_bc = {
-            'AAAAA': ['hit1', 'hit2'],
-            'AAAAG': ['hit3'],
-            'TTTTN': ['hit42'],
-            'GGGGG': ['hit4', 'hit5'],
-            'NAAAN': ['hit6'],
-        }
-        expected = {
-            'GGGGG': ['hit4', 'hit5'],
-            'AAAAA': ['hit1', 'hit2', 'hit6'],
-            'AAAAG': ['hit3'],
-            'TTTTN': ['hit42'],
-        }
-        xlsites._merge_similar_randomers(by_bc, mismatches=2, max_barcodes=10000, ratio_th=0.1)  # 1/10
-        self.assertEqual(by_bc, expected)
-
-    def test_merge_ratio_th(self):
-        # hit1, hit2, ... should all be a 4-tuple, but for this test it is ok as is
-        by_bc = {
-            'AAAAA': ['hit1', 'hit2', 'hit4', 'hit5', 'hit6'],
-            'GGGGG': ['hit7', 'hit8'],
-            'GGGGC': ['hit14', 'hit15'],
-            'GGGGA': ['hit9'],
-            'AAAAG': ['hit10'],
-            'GAAAG': ['hit11'],
-            'CCCCC': ['hit12'],
-            'CCCCG': ['hit13'],
-        }
-        expected = {
-            'AAAAA': ['hit1', 'hit2', 'hit4', 'hit5', 'hit6', 'hit10'],
-            'GGGGG': ['hit7', 'hit8', 'hit9'],
-            'GGGGC': ['hit14', 'hit15'],
-            'GAAAG': ['hit11'],
-            'CCCCG': ['hit13', 'hit12'],
-        }
-        xlsites._merge_similar_randomers(by_bc, mismatches=1, max_barcodes=10000, ratio_th=0.4)  # 2/5
-        self.assertEqual(by_bc, expected)
-
-    def test_max_barcodes(self):
-        # hit1, hit2, ... should all be a 4-tuple, but for this test it is ok as is
-        by_bc = {
-            'AAAAA': ['hit1', 'hit2', 'hit3', 'hit4'],
-            'AAAAG': ['hit5', 'hit6'],
-            'AAAAT': ['hit7'],
-        }
-        expected_max_barcodes_1 = {
-            'AAAAA': ['hit1', 'hit2', 'hit3', 'hit4'],
-            'AAAAG': ['hit5', 'hit6'],
-            'AAAAT': ['hit7'],
-        }
-        xlsites._merge_similar_randomers(by_bc, mismatches=2, max_barcodes=1, ratio_th=0.5)
-        self.assertEqual(by_bc, expected_max_barcodes_1)
-
-        expected_max_barcodes_10 = {
-            'AAAAA': ['hit1', 'hit2', 'hit3', 'hit4', 'hit7'],
-            'AAAAG': ['hit5', 'hit6'],
-        }
-        xlsites._merge_similar_randomers(by_bc, mismatches=2, max_barcodes=10, ratio_th=0.5)
-        self.assertEqual(by_bc, expected_max_barcodes_10)
-
-    @unittest.skip
-    def test_todo(self):
-        """
-        This test fails since we currently do not support the feature of finding
-        the most similar match. Rather than that, we accept the first match even
-        though better one is available.
-        """
-
-        # hit1, hit2, should be a 4-tuple, but for this test it is ok as is
-        by_bc = {
-            'AAAAA': ['hit1'],
-            'AACGG': ['hit2', 'hit3'],
-            'NAAAN': ['hit4'],
-        }
-        xlsites._merge_similar_randomers(by_bc, mismatches=2, max_barcodes=10000)
+    def test_borders(self):
+        segmentation = make_file_from_list([
+            ['1', '.', 'gene', '10', '300', '.', '+', '.', 'gene_id "G1";'],
+            ['1', '.', 'transcript', '101', '200', '.', '+', '.', 'gene_id "G1"; transcript_id "T1";'],
+            ['1', '.', 'CDS', '101', '150', '.', '+', '.', 'gene_id "G1"; transcript_id "T1";'],
+            ['1', '.', 'intron', '151', '200', '.', '+', '.', 'gene_id "G1"; transcript_id "T1";'],
+            ['2', '.', 'UTR3', '51', '100', '.', '-', '.', 'gene_id "G2"; transcript_id "T2";'],
+        ])
         expected = {
-            'AACGG': ['hit2', 'hit3'],
-            'AAAAA': ['hit1', 'hit4'],
-        }
-        self.assertEqual(by_bc, expected)
-
-
-class TestCollapse(unittest.TestCase):
-
-    def setUp(self):
-        warnings.simplefilter("ignore", ResourceWarning)
-
-    def test_start_1(self):
-        """
-        Two barcodes, one with two second_start groups.
-        No multimax situation yet.
-        """
-        by_bc = {
-            'AAAAA': [
-                # (middle_pos, end_pos, read_len, num_mapped, cigar, second_start)
-                (5, 10, 10, 1, 0),
-                (5, 10, 10, 1, 0),
-                (5, 30, 20, 1, 20),
-            ],
-            'CCCCC': [
-                (5, 10, 10, 1, 0),
-                (5, 10, 10, 1, 0),
-            ],
-        }
-        result1 = xlsites._collapse(1, by_bc, 'start', multimax=1)
-        expected1 = {1: (3.0, 5)}
-        self.assertEqual(result1, expected1)
-
-    def test_start_2(self):
-        """
-        Two barcodes, multimax case.
-        """
-        by_bc = {
-            'AAAAA': [
-                # (middle_pos, end_pos, read_len, num_mapped, cigar, second_start)
-                (5, 10, 10, 1, 0),
-                (5, 10, 10, 1, 0),
-                (15, 30, 20, 2, 0),
-            ],
-            'CCCCC': [
-                (5, 10, 10, 1, 0),
-                (5, 10, 10, 100, 0),  # Excluded becouse of multimax
-            ],
-        }
-        result1 = xlsites._collapse(1, by_bc, 'start', multimax=10)
-        expected1 = {1: (1.75, 4)}
-        self.assertEqual(result1, expected1)
-
-    def test_middle(self):
-        xlink_pos = 1
-        report_by = 'middle'
-        by_bc = {
-            'AAAAA': [
-                # (middle_pos, end_pos, read_len, num_mapped, cigar, second_start)
-                (5, 10, 10, 1, 0),
-                (5, 10, 10, 1, 0),
-                (40, 80, 80, 8, 0)],
-            'CCCCC': [
-                (5, 10, 10, 1, 0),
-                (25, 30, 10, 10, 0)]}
-
-        # Multimax = 1
-        result1 = xlsites._collapse(xlink_pos, by_bc, report_by, multimax=1)
-        expected1 = {5: (2.0, 3)}
-        self.assertEqual(result1, expected1)
-
-        # Multimax = 10
-        result2 = xlsites._collapse(xlink_pos, by_bc, report_by, multimax=10)
-        expected2 = {5: (0.7, 3), 40: (0.1, 1), 25: (0.05, 1)}
-        self.assertEqual(result2, expected2)
-
-    def test_end(self):
-        xlink_pos = 1
-        report_by = 'end'
-        by_bc = {
-            'AAAAA': [
-                # (middle_pos, end_pos, read_len, num_mapped, cigar, second_start)
-                (1, 10, 10, 1, 0),
-                (1, 10, 10, 1, 0),
-                (1, 80, 80, 8, 0),
-            ],
-            'CCCCC': [
-                (1, 10, 10, 1, 0),
-                (15, 20, 10, 10, 0),
-            ],
+            '1': {'+': {100, 150}, '-': {150, 200}},
+            '2': {'+': {50}, '-': {100}},
         }
+        self.assertEqual(xlsites._load_segment_borders(segmentation), expected)
 
-        # Multimax = 1
-        result1 = xlsites._collapse(xlink_pos, by_bc, report_by, multimax=1)
-        expected1 = {10: (2.0, 3)}
-        self.assertEqual(result1, expected1)
-
-        # Multimax = 10
-        result2 = xlsites._collapse(xlink_pos, by_bc, report_by, multimax=10)
-        expected2 = {10: (0.7, 3), 80: (0.1, 1), 20: (0.05, 1)}
-        self.assertEqual(result2, expected2)
+    def test_empty(self):
+        self.assertEqual(xlsites._load_segment_borders(make_file_from_list([], bedtool=False)), {})
 
 
 class TestIntersectsWithAnnotaton(unittest.TestCase):
 
     def setUp(self):
         warnings.simplefilter("ignore", ResourceWarning)
+        self.segmentation = xlsites._load_segment_borders(make_file_from_list([
+            ['1', '.', 'gene', '100', '200', '.', '+', '.', 'gene_id "G1";'],
+            ['1', '.', 'CDS', '101', '150', '.', '+', '.', 'gene_id "G1"; transcript_id "T1";'],
+        ]))['1']
 
     def test_pos_strand(self):
-        segmentation = {
-            'gene_id_001': {
-                'tr_id_0001': [
-                    mock.MagicMock(start=100),
-                ],
-                'gene_segment': [],
-            }
-        }
         self.assertTrue(
-            xlsites._intersects_with_annotaton(100, segmentation, 1, '+'))
+            xlsites._intersects_with_annotaton(100, self.segmentation, '1', '+'))
         self.assertFalse(
-            xlsites._intersects_with_annotaton(101, segmentation, 1, '+'))
+            xlsites._intersects_with_annotaton(101, self.segmentation, '1', '+'))
 
     def test_neg_strand(self):
-        segmentation = {
-            'gene_id_002': {
-                'tr_id_0003': [
-                    mock.MagicMock(stop=100),
-                ]
-            },
-        }
         self.assertTrue(
-            xlsites._intersects_with_annotaton(100, segmentation, 2, '-'))
+            xlsites._intersects_with_annotaton(150, self.segmentation, '1', '-'))
         self.assertFalse(
-            xlsites._intersects_with_annotaton(101, segmentation, 2, '-'))
+            xlsites._intersects_with_annotaton(100, self.segmentation, '1', '-'))
 
 
 class TestSecondStart(unittest.TestCase):
@@ -312,54 +70,57 @@ class TestSecondStart(unittest.TestCase):
         warnings.simplefilter("ignore", ResourceWarning)
 
     def test_second_start_segmentation(self):
-        segmentation = {
-            'G001': {
-                'gene_segment': [],
-                'T0001': [
-                    pybedtools.create_interval_from_list(
-                        ['1', '.', 'exon', '100', '200', '.', '+', '.',
-                         'gene_id: "G001"', 'transcript_id: "T0001"']),
-                ],
-            },
-            'G002': {
-                'gene_segment': [],
-                'T0002': [
-                    pybedtools.create_interval_from_list(
-                        ['1', '.', 'exon', '50', '100', '.', '-', '.',
-                         'gene_id: "G001"', 'transcript_id: "T0001"']),
-                ],
-            },
-        }
+        segmentation = xlsites._load_segment_borders(make_file_from_list([
+            ['1', '.', 'exon', '100', '200', '.', '+', '.', 'gene_id "G001"; transcript_id "T0001";'],
+            ['1', '.', 'exon', '50', '100', '.', '-', '.', 'gene_id "G002"; transcript_id "T0002";'],
+        ]))['1']
 
         second_start, _ = xlsites._second_start(
-            read=0, poss=(1, 2, 99, 100), strand='+', chrom=1,
+            read=0, blocks=[(1, 3), (99, 101)], strand='+', chrom=1,
             segmentation=segmentation, holesize_th=4)
         self.assertEqual(second_start, 99)
 
         second_start, _ = xlsites._second_start(
-            read=0, poss=(99, 100, 199, 200), strand='-', chrom=1,
+            read=0, blocks=[(99, 101), (199, 201)], strand='-', chrom=1,
             segmentation=segmentation, holesize_th=4)
         self.assertEqual(second_start, 100)
 
         second_start, _ = xlsites._second_start(
-            read=0, poss=(1, 2, 4, 5), strand='-', chrom=1,
+            read=0, blocks=[(1, 3), (4, 6)], strand='-', chrom=1,
             segmentation=segmentation, holesize_th=4)
         self.assertEqual(second_start, 2)
 
     def test_second_start_no_seg(self):
         # If hole size is lower than holesize_th, strange should be empty:
         _, is_strange = xlsites._second_start(
-            read='the_read', poss=(1, 2, 5, 6), strand='+', chrom=1,
+            read='the_read', blocks=[(1, 3), (5, 7)], strand='+', chrom=1,
             segmentation=None, holesize_th=1)
         self.assertTrue(is_strange)
 
         # If hole size is lower than holesize_th, strange should be empty:
         _, is_strange = xlsites._second_start(
-            read='the_read', poss=(1, 2, 5, 6), strand='+', chrom=1,
+            read='the_read', blocks=[(1, 3), (5, 7)], strand='+', chrom=1,
             segmentation=None, holesize_th=2)
         self.assertFalse(is_strange)
 
 
+class TestGetAlignedPosition(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_same_as_positions(self):
+        blocks = [(10, 13), (20, 21), (21, 23), (40, 42)]
+        positions = [10, 11, 12, 20, 21, 22, 40, 41]
+        for index in range(-len(positions), len(positions)):
+            self.assertEqual(xlsites._get_aligned_position(blocks, index), positions[index])
+
+        with self.assertRaises(IndexError):
+            xlsites._get_aligned_position(blocks, len(positions))
+        with self.assertRaises(IndexError):
+            xlsites._get_aligned_position(blocks, -len(positions) - 1)
+
+
 class TestProcessBamFile(unittest.TestCase):
 
     def setUp(self):
@@ -458,6 +219,307 @@ class TestProcessBamFile(unittest.TestCase):
         ]
         self.assertEqual(grouped, expected)
 
+    def test_barcode_tag(self):
+        bam_fname = make_bam_file({
+            'chromosomes': [('chr1', 3000)],
+            'segments': [
+                # (qname, flag, refname, pos, mapq, cigar, tags)
+                ('_:rbc:AAA', 0, 0, 50, 255, [(0, 101)], {'NH': 1, 'RX': 'CCC'}),
+                ('_:rbc:AAA', 0, 0, 50, 255, [(0, 101)], {'NH': 1, 'RX': 'GGG'}),
+            ],
+        }, rnd_seed=0)
+        grouped = list(xlsites._processs_bam_file(
+            bam_fname, self.metrics, 10, self.tmp, barcode_tag='RX'))
+
+        expected = [
+            (('chr1', '+'), 0.0167, {
+                49: {
+                    'CCC': [(100, 150, 101, 1, 0)],
+                    'GGG': [(100, 150, 101, 1, 0)],
+                }
+            }),
+        ]
+        self.assertEqual(grouped, expected)
+
+    def test_sliding_window(self):
+        """
+        Complete positions are yielded before the end of chromosome.
+        """
+        bam_fname = make_bam_file({
+            'chromosomes': [('chr1', 3000)],
+            'segments': [
+                # (qname, flag, refname, pos, mapq, cigar, tags)
+                ('_:rbc:AAA', 0, 0, 50, 255, [(0, 101)], {'NH': 1}),
+                ('_:rbc:CCC', 16, 0, 50, 255, [(0, 100)], {'NH': 1}),
+                ('_:rbc:GGG', 0, 0, 1000, 255, [(0, 101)], {'NH': 1}),
+                ('_:rbc:TTT', 0, 0, 1000, 255, [(0, 101)], {'NH': 1}),
+            ],
+        }, rnd_seed=0)
+        with mock.patch('iCount.mapping.xlsites.FLUSH_INTERVAL', 3):
+            grouped = list(xlsites._processs_bam_file(bam_fname, self.metrics, 10, self.tmp))
+
+        expected = [
+            (('chr1', '+'), 0.333, {49: {'AAA': [(100, 150, 101, 1, 0)]}}),
+            (('chr1', '-'), 0.333, {150: {'CCC': [(99, 50, 100, 1, 0)]}}),
+            (('chr1', '+'), 0.3333, {999: {
+                'GGG': [(1050, 1100, 101, 1, 0)],
+                'TTT': [(1050, 1100, 101, 1, 0)],
+            }}),
+        ]
+        self.assertEqual(grouped, expected)
+
+
+class TestCram(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+        self.reference = make_fasta_file(headers=['chr1'], seq_len=3000, rnd_seed=0)
+        self.bam_fname = make_bam_file({
+            'chromosomes': [('chr1', 3000)],
+            'segments': [
+                ('_:rbc:AAA', 0, 0, 500, 255, [(0, 100)], {'NH': 1}),
+                ('_:rbc:CCC', 16, 0, 50, 255, [(0, 100)], {'NH': 1}),
+                ('_:rbc:GGG', 0, 0, 1000, 255, [(0, 50), (3, 400), (0, 50)], {'NH': 1}),
+            ],
+        }, rnd_seed=0)
+        self.cram_fname = get_temp_file_name(extension='cram')
+        # pylint: disable=no-member
+        pysam.view('-C', '-T', self.reference, '-o', self.cram_fname, self.bam_fname,
+                   catch_stdout=False)
+
+    def process(self, bam_fname, skipped, **kwargs):
+        metrics = mock.MagicMock()
+        return list(xlsites._processs_bam_file(bam_fname, metrics, 0, skipped, gap_th=100,
+                                               **kwargs))
+
+    def test_unsorted(self):
+        bam_fname, index, tmp_files = bam.ensure_sorted_indexed(
+            self.cram_fname, reference=self.reference)
+        self.assertTrue(bam_fname.endswith('.bam'))
+        self.assertEqual(tmp_files, [bam_fname, index])
+        with pysam.AlignmentFile(bam_fname, index_filename=index) as bamfile:
+            self.assertEqual([read.reference_start for read in bamfile.fetch('chr1')],
+                             [50, 500, 1000])
+
+    def test_sorted_no_index(self):
+        sorted_fname = get_temp_file_name(extension='cram')
+        # pylint: disable=no-member
+        pysam.sort('--reference', self.reference, '-O', 'cram', '-o', sorted_fname,
+                   self.cram_fname)
+        bam_fname, index, tmp_files = bam.ensure_sorted_indexed(
+            sorted_fname, reference=self.reference)
+        self.assertEqual(bam_fname, sorted_fname)
+        self.assertTrue(index.endswith('.crai'))
+        self.assertEqual(tmp_files, [index])
+
+    def test_same_as_bam(self):
+        bam_skipped = get_temp_file_name(extension='bam')
+        cram_skipped = get_temp_file_name(extension='cram')
+        expected = self.process(self.bam_fname, bam_skipped)
+        result = self.process(self.cram_fname, cram_skipped, reference=self.reference)
+        self.assertEqual(result, expected)
+
+        with pysam.AlignmentFile(bam_skipped) as bamfile:
+            expected = [(read.query_name, read.reference_start, read.cigarstring)
+                        for read in bamfile.fetch(until_eof=True)]
+        with pysam.AlignmentFile(cram_skipped, reference_filename=self.reference) as cramfile:
+            self.assertTrue(cramfile.is_cram)
+            result = [(read.query_name, read.reference_start, read.cigarstring)
+                      for read in cramfile.fetch(until_eof=True)]
+        self.assertEqual(result, expected)
+        self.assertEqual([name for name, _, _ in result], ['_:rbc:GGG'])
+
+    def test_output_without_reference(self):
+        fnames = [get_temp_file_name(extension=ext) for ext in ['bed', 'bed', 'cram']]
+        with self.assertRaisesRegex(ValueError, 'reference is needed'):
+            xlsites.run(self.bam_fname, *fnames)
+        with self.assertRaisesRegex(ValueError, 'reference is needed'):
+            xlsites_state.xlsites_update(get_temp_file_name(), *fnames, [self.bam_fname])
+        self.assertFalse(os.path.exists(fnames[2]))
+
+        xlsites.run(self.bam_fname, *fnames, reference=self.reference)
+        with pysam.AlignmentFile(fnames[2], reference_filename=self.reference) as cramfile:
+            self.assertTrue(cramfile.is_cram)
+
+
+class TestGetRegions(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_split_long_contigs(self):
+        bamfile = mock.MagicMock(references=('chr1', 'chr2'), lengths=(3000, 1000))
+        with mock.patch('iCount.mapping.xlsites.MIN_CHUNK_SIZE', 1000):
+            regions = xlsites._get_regions(bamfile, processes=2)
+        expected = [
+            ('chr1', None, 1000),
+            ('chr1', 1000, 2000),
+            ('chr1', 2000, None),
+            ('chr2', None, None),
+        ]
+        self.assertEqual(regions, expected)
+
+    def test_no_split(self):
+        bamfile = mock.MagicMock(references=('chr1', 'chr2'), lengths=(3000, 1000))
+        regions = xlsites._get_regions(bamfile, processes=2)
+        self.assertEqual(regions, [('chr1', None, None), ('chr2', None, None)])
+
+
+class TestProcessBamFileParallel(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+        self.bam_fname = make_bam_file({
+            'chromosomes': [('chr1', 3000), ('chr2', 2000)],
+            'segments': [
+                ('name1', 4, 0, 100, 20, [(0, 100)], {'NH': 1}),
+                ('name2:rbc:AAAA', 0, 0, 100, 20, [(0, 201)], {'NH': 1}),
+                ('name3:rbc:AAAT', 0, 0, 100, 20, [(0, 201)], {'NH': 2}),
+                ('name4:rbc:CCCC', 16, 0, 1450, 20, [(0, 50), (3, 20), (0, 50)], {'NH': 1}),
+                ('name5:rbc:GGGG', 16, 0, 1451, 20, [(0, 49)], {'NH': 1}),
+                ('name6:rbc:GGGG', 0, 0, 1501, 20, [(0, 50)], {'NH': 1}),
+                ('name7:rbc:ACGT', 0, 1, 300, 20, [(0, 200)], {'NH': 1}),
+                ('name8:rbc:ACGT', 0, 1, 300, 3, [(0, 200)], {'NH': 1}),
+            ],
+        }, rnd_seed=0)
+        self.params = dict(group_by='start', mismatches=1, multimax=50, ratio_th=0.1,
+                           max_barcodes=10000)
+
+    def run_serial(self):
+        metrics = mock.MagicMock()
+        single, multi = {}, {}
+        skipped = get_temp_file_name(extension='bam')
+        for (chrom, strand), _, by_pos in xlsites._processs_bam_file(
+                self.bam_fname, metrics, 10, skipped, gap_th=4):
+            xlsites_common._quantify(by_pos, single.setdefault((chrom, strand), {}),
+                              multi.setdefault((chrom, strand), {}), **self.params)
+        return single, multi, metrics
+
+    def test_same_as_serial(self):
+        single, multi, metrics = self.run_serial()
+
+        for chunk_size in (10 ** 7, 1000, 500):
+            metrics_parallel = mock.MagicMock()
+            single_parallel, multi_parallel = {}, {}
+            with mock.patch('iCount.mapping.xlsites.MIN_CHUNK_SIZE', chunk_size):
+                xlsites._processs_bam_file_parallel(
+                    self.bam_fname, metrics_parallel, 10, get_temp_file_name(extension='bam'),
+                    single_parallel, multi_parallel, 2, gap_th=4, **self.params)
+
+            self.assertEqual(single_parallel, {k: v for k, v in single.items() if v})
+            self.assertEqual(multi_parallel, {k: v for k, v in multi.items() if v})
+            for name in ['all_recs', 'notmapped_recs', 'mapped_recs', 'lowmapq_recs',
+                         'used_recs', 'strange_recs', 'bc_cn']:
+                self.assertEqual(getattr(metrics_parallel, name), getattr(metrics, name))
+
+
+class TestReadAhead(unittest.TestCase):
+
+    def test_order(self):
+        for size in [0, 1, 5, 6, 7, 100]:
+            records = list(range(size))
+            self.assertEqual(list(xlsites._read_ahead(records, batch_size=3, max_batches=1)), records)
+
+    def test_error(self):
+        def records():
+            yield 1
+            raise ValueError('Broken')
+
+        read = xlsites._read_ahead(records(), batch_size=1)
+        self.assertEqual(next(read), 1)
+        with self.assertRaisesRegex(ValueError, 'Broken'):
+            next(read)
+
+    def test_close(self):
+        threads = threading.active_count()
+        read = xlsites._read_ahead(iter(range(1000)), batch_size=2, max_batches=1)
+        self.assertEqual(next(read), 0)
+        read.close()
+        self.assertEqual(threading.active_count(), threads)
+
+    @mock.patch.object(xlsites, 'READ_AHEAD_BATCH_SIZE', 2)
+    @mock.patch.object(xlsites.os, 'cpu_count', return_value=4)
+    def test_run(self, _):
+        data = {
+            'chromosomes': [('chr1', 3000), ('chr2', 2000)],
+            'segments': [
+                ('_:rbc:{}'.format(barcode), flag, chrom, 100 + 10 * i, 255, [(0, 50)], {'NH': 1})
+                for i, barcode in enumerate(['AAA', 'CCC', 'AAT', 'GGG', 'TTT'])
+                for flag in [0, 16] for chrom in [0, 1]
+            ],
+        }
+        bam_fname = make_bam_file(data, rnd_seed=0)
+        outputs = []
+        for batches in [0, 1]:
+            with mock.patch.object(xlsites, 'READ_AHEAD_BATCHES', batches):
+                fnames = [get_temp_file_name(extension=ext) for ext in ['bed', 'bed', 'bam']]
+                xlsites.run(bam_fname, *fnames)
+            with open(fnames[0]) as single, open(fnames[1]) as multi:
+                outputs.append((single.read(), multi.read()))
+        self.assertEqual(outputs[0], outputs[1])
+
+
+class TestRegions(unittest.TestCase):
+
+    def setUp(self):
+        self.data = {
+            'chromosomes': [('chr1', 3000), ('chr2', 2000)],
+            'segments': [
+                # Cross-links on both sides of left edge of target interval:
+                ('_:rbc:AAA', 0, 0, 99, 255, [(0, 50)], {'NH': 1}),
+                ('_:rbc:CCC', 0, 0, 100, 255, [(0, 50)], {'NH': 1}),
+                ('_:rbc:GGG', 16, 0, 49, 255, [(0, 49)], {'NH': 1}),
+                ('_:rbc:TTT', 16, 0, 49, 255, [(0, 50)], {'NH': 1}),
+                # Cross-links on both sides of right edge of target interval:
+                ('_:rbc:AAA', 0, 0, 200, 255, [(0, 50)], {'NH': 1}),
+                ('_:rbc:CCC', 0, 0, 201, 255, [(0, 50)], {'NH': 1}),
+                ('_:rbc:GGG', 16, 0, 150, 255, [(0, 49)], {'NH': 1}),
+                ('_:rbc:TTT', 16, 0, 150, 255, [(0, 50)], {'NH': 1}),
+                # Outside of target intervals:
+                ('_:rbc:AAA', 0, 0, 1000, 255, [(0, 50)], {'NH': 1}),
+                ('_:rbc:AAA', 0, 1, 1000, 255, [(0, 50)], {'NH': 1}),
+            ],
+        }
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_get_target_regions(self):
+        regions = make_file_from_list([
+            ['chr2', 50, 60, '.', '0', '+'],
+            ['chr1', 300, 400, '.', '0', '+'],
+            ['chr1', 100, 200, '.', '0', '-'],
+            ['chr1', 150, 250, '.', '0', '+'],
+            ['chr1', 250, 260, '.', '0', '+'],
+            ['chrX', 100, 200, '.', '0', '+'],
+        ], bedtool=False, extension='bed')
+        bam_fname = make_bam_file(self.data, rnd_seed=0)
+        with pysam.AlignmentFile(bam_fname, 'rb') as bamfile:
+            self.assertEqual(xlsites._get_target_regions(bamfile, regions), [
+                ('chr1', 100, 260),
+                ('chr1', 300, 400),
+                ('chr2', 50, 60),
+            ])
+
+    def test_run(self):
+        regions = make_file_from_list([['chr1', 99, 200, '.', '0', '+']], bedtool=False,
+                                      extension='bed')
+        bam_fname = make_bam_file(self.data, rnd_seed=0)
+        sites_all = get_temp_file_name(extension='bed')
+        xlsites.run(bam_fname, sites_all, get_temp_file_name(extension='bed'),
+                    get_temp_file_name(extension='bam'))
+        with open(sites_all) as handle:
+            lines = [line.split('\t') for line in handle]
+        expected = [line for line in lines if line[0] == 'chr1' and 99 <= int(line[1]) < 200]
+        self.assertEqual(len(expected), 4)
+
+        for processes in [1, 2]:
+            sites = get_temp_file_name(extension='bed')
+            metrics = xlsites.run(bam_fname, sites, get_temp_file_name(extension='bed'),
+                                  get_temp_file_name(extension='bam'), regions=regions,
+                                  processes=processes)
+            with open(sites) as handle:
+                self.assertEqual([line.split('\t') for line in handle], expected)
+            self.assertEqual(metrics.used_recs, 4)
+
 
 class TestRun(unittest.TestCase):
 
@@ -515,6 +577,168 @@ class TestRun(unittest.TestCase):
         # Strange counter:
         self.assertEqual(result.strange_recs, 1)
 
+    def _run(self, bam_fname, **kwargs):
+        """Run xlsites and return content of output files and metrics."""
+        fnames = [get_temp_file_name(extension=ext) for ext in ['bed', 'bed', 'bam']]
+        metrics = xlsites.run(bam_fname, *fnames, mapq_th=5, **kwargs)
+        with open(fnames[0]) as single, open(fnames[1]) as multi, \
+                pysam.AlignmentFile(fnames[2], 'rb') as skipped:
+            output = (single.read(), multi.read(), [read.query_name for read in skipped])
+        counters = {name: value for name, value in vars(metrics).items() if name != 'context'}
+        return output, counters
+
+    def test_threads(self):
+        bam_fname = make_bam_file(self.data, rnd_seed=0)
+        expected = self._run(bam_fname)
+        self.assertEqual(self._run(bam_fname, threads=3), expected)
+        self.assertEqual(self._run(bam_fname, threads=3, processes=2), expected)
+
+    def test_checkpoint(self):
+        bam_fname = make_bam_file(self.data, rnd_seed=0)
+        expected = self._run(bam_fname)
+        checkpoint_dir = get_temp_dir()
+        manifest_fname = os.path.join(checkpoint_dir, xlsites_checkpoint.CHECKPOINT_MANIFEST)
+
+        self.assertEqual(self._run(bam_fname, checkpoint_dir=checkpoint_dir), expected)
+        with open(manifest_fname) as handle:
+            manifest = json.load(handle)
+        self.assertEqual(manifest['chromosomes'], {'chr1': 'shard0', 'chr2': 'shard1'})
+        self.assertEqual(manifest['parameters']['mapq_th'], 5)
+
+        # Pretend that run was interrupted while processing chr2.
+        del manifest['chromosomes']['chr2']
+        with open(manifest_fname, 'wt') as handle:
+            json.dump(manifest, handle)
+        shard_fname = os.path.join(checkpoint_dir, 'shard0.pkl')
+        shard_mtime = os.stat(shard_fname).st_mtime_ns
+
+        self.assertEqual(
+            self._run(bam_fname, checkpoint_dir=checkpoint_dir, resume=True, processes=2), expected)
+        # Completed chromosome is not processed again.
+        self.assertEqual(os.stat(shard_fname).st_mtime_ns, shard_mtime)
+        with open(manifest_fname) as handle:
+            self.assertEqual(json.load(handle)['chromosomes'], {'chr1': 'shard0', 'chr2': 'shard1'})
+
+    def test_checkpoint_mismatch(self):
+        bam_fname = make_bam_file(self.data, rnd_seed=0)
+        checkpoint_dir = get_temp_dir()
+        self._run(bam_fname, checkpoint_dir=checkpoint_dir)
+
+        with self.assertRaisesRegex(ValueError, 'different parameters'):
+            self._run(bam_fname, checkpoint_dir=checkpoint_dir, resume=True, mismatches=2)
+
+        other_fname = make_bam_file(self.data, rnd_seed=1)
+        with self.assertRaisesRegex(ValueError, 'different BAM file'):
+            self._run(other_fname, checkpoint_dir=checkpoint_dir, resume=True)
+
+        # Input is not read when checkpoint is made or checked:
+        with mock.patch('builtins.open', wraps=open) as open_:
+            xlsites_checkpoint._Checkpoint(checkpoint_dir, bam_fname, {}, resume=False)
+            self.assertNotIn(bam_fname, [call[0][0] for call in open_.call_args_list])
+
+        # Modified input is treated as different:
+        os.utime(bam_fname, ns=(0, 0))
+        with self.assertRaisesRegex(ValueError, 'different BAM file'):
+            self._run(bam_fname, checkpoint_dir=checkpoint_dir, resume=True)
+
+        # Without resume, checkpoint is started from scratch.
+        self.assertEqual(self._run(other_fname, checkpoint_dir=checkpoint_dir), self._run(other_fname))
+
+    def test_sample_fraction(self):
+        names = ['read{}:rbc:AAAA'.format(i) for i in range(20)]
+        segments = []
+        for i, name in enumerate(names):
+            # Each read is mapped to two positions.
+            segments.append((name, 0, 0, 100 + 10 * i, 20, [(0, 50)], {'NH': 2}))
+            segments.append((name, 0, 1, 100 + 10 * i, 20, [(0, 50)], {'NH': 2}))
+        bam_fname = make_bam_file({
+            'chromosomes': [('chr1', 3000), ('chr2', 3000)],
+            'segments': segments,
+        }, rnd_seed=0)
+        threshold = xlsites._get_sample_threshold(0.5)
+        kept = [i for i, name in enumerate(names) if zlib.crc32(name.encode()) < threshold]
+        self.assertTrue(0 < len(kept) < len(names))
+
+        (_, multi, _), counters = self._run(bam_fname, sample_fraction=0.5)
+        expected = ''.join(
+            '{}\t{}\t{}\t.\t1\t+\n'.format(chrom, 99 + 10 * i, 100 + 10 * i)
+            for chrom in ['chr1', 'chr2'] for i in kept)
+        self.assertEqual(multi, expected)
+        self.assertEqual(counters['sample_fraction'], 0.5)
+        self.assertEqual(counters['unsampled_recs'], 2 * (len(names) - len(kept)))
+        self.assertEqual(counters['used_recs'], 2 * len(kept))
+
+        # Same reads are selected when processing in multiple processes:
+        output, _ = self._run(bam_fname, sample_fraction=0.5, processes=2)
+        self.assertEqual(output[1], expected)
+
+        # All reads are used by default:
+        output, counters = self._run(bam_fname)
+        self.assertEqual(len(output[1].splitlines()), 2 * len(names))
+        self.assertEqual(counters['unsampled_recs'], 0)
+
+    def test_state_update(self):
+        first = [
+            ('name1:rbc:AAAA', 0, 0, 100, 20, [(0, 50)], {'NH': 1}),
+            ('name2:rbc:AAAA', 0, 0, 100, 20, [(0, 60)], {'NH': 1}),
+            ('name3:rbc:CCCC', 16, 0, 300, 20, [(0, 40)], {'NH': 2}),
+            ('name3:rbc:CCCC', 0, 1, 500, 20, [(0, 40)], {'NH': 2}),
+            ('name4:rbc:GGGG', 0, 1, 800, 20, [(0, 50)], {'NH': 1}),
+        ]
+        second = [
+            # Touched positions:
+            ('name5:rbc:AAAT', 0, 0, 100, 20, [(0, 50)], {'NH': 1}),
+            ('name6:rbc:TTTT', 0, 0, 100, 20, [(0, 50)], {'NH': 1}),
+            ('name7:rbc:CCCC', 16, 0, 300, 20, [(0, 40)], {'NH': 1}),
+            # New position:
+            ('name8:rbc:ACGT', 0, 1, 1200, 20, [(0, 50)], {'NH': 1}),
+            # Skipped record:
+            ('name9:rbc:ACGT', 0, 1, 1500, 20, [(0, 50), (3, 100), (0, 50)], {'NH': 1}),
+        ]
+        chromosomes = [('chr1', 3000), ('chr2', 2000)]
+        first_fname = make_bam_file({'chromosomes': chromosomes, 'segments': first}, rnd_seed=0)
+        second_fname = make_bam_file({'chromosomes': chromosomes, 'segments': second}, rnd_seed=0)
+        all_fname = make_bam_file({'chromosomes': chromosomes, 'segments': first + second},
+                                  rnd_seed=0)
+
+        for group_by in ['start', 'middle']:
+            (single, multi, skipped), counters = self._run(all_fname, group_by=group_by)
+
+            state = get_temp_file_name(extension='pkl')
+            self._run(first_fname, group_by=group_by, state=state)
+            fnames = [get_temp_file_name(extension=ext) for ext in ['bed', 'bed', 'bam']]
+            metrics = xlsites_state.xlsites_update(state, *fnames, [second_fname])
+            with open(fnames[0]) as handle:
+                self.assertEqual(handle.read(), single)
+            with open(fnames[1]) as handle:
+                self.assertEqual(handle.read(), multi)
+            with pysam.AlignmentFile(fnames[2], 'rb') as handle:
+                self.assertEqual([read.query_name for read in handle.fetch(until_eof=True)],
+                                 skipped)
+            self.assertEqual(metrics.used_recs, counters['used_recs'])
+            self.assertEqual(metrics.bc_cn, counters['bc_cn'])
+
+            # State file is updated, further reads are added to all previous ones.
+            metrics = xlsites_state.xlsites_update(state, *fnames, [second_fname])
+            self.assertEqual(metrics.used_recs, counters['used_recs'] + len(second))
+            with open(fnames[1]) as handle:
+                self.assertNotEqual(handle.read(), multi)
+
+    def test_state_errors(self):
+        bam_fname = make_bam_file(self.data, rnd_seed=0)
+        with self.assertRaises(AssertionError):
+            self._run(bam_fname, state=get_temp_file_name(extension='pkl'), processes=2)
+
+        not_state = get_temp_file_name(extension='pkl')
+        with open(not_state, 'wb') as handle:
+            pickle.dump({'version': 0}, handle)
+        fnames = [get_temp_file_name(extension=ext) for ext in ['bed', 'bed', 'bam']]
+        with self.assertRaisesRegex(ValueError, 'is not xlsites state file'):
+            xlsites_state.xlsites_update(not_state, *fnames, [bam_fname])
+
+        with self.assertRaisesRegex(ValueError, 'At least one BAM file'):
+            xlsites_state.xlsites_update(not_state, *fnames, [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,67 @@
+# pylint: disable=missing-docstring, protected-access
+
+import warnings
+import unittest
+
+from iCount.mapping import xlsites, xlsites_batch
+from iCount.tests.utils import get_temp_file_name, make_bam_file
+
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_same_as_run(self):
+        bams = [
+            make_bam_file({
+                'chromosomes': [('chr1', 3000), ('chr2', 2000)],
+                'segments': [
+                    # (qname, flag, refname, pos, mapq, cigar, tags)
+                    ('_:rbc:AAA', 0, 0, 50, 255, [(0, 101)], {'NH': 1}),
+                    ('_:rbc:CCC', 16, 0, 50, 255, [(0, 100)], {'NH': 2}),
+                    ('_:rbc:GGG', 0, 1, 1000, 255, [(0, 101)], {'NH': 1}),
+                ],
+            }, rnd_seed=0),
+            make_bam_file({
+                'chromosomes': [('chr1', 3000)],
+                'segments': [
+                    ('_:rbc:AAA', 0, 0, 80, 255, [(0, 50)], {'NH': 1}),
+                    ('_:rbc:AAT', 0, 0, 80, 255, [(0, 50)], {'NH': 1}),
+                ],
+            }, rnd_seed=0),
+        ]
+
+        manifest = get_temp_file_name(extension='tsv')
+        expected, outputs = [], []
+        with open(manifest, 'wt') as handle:
+            for bam in bams:
+                files = [get_temp_file_name(extension=ext) for ext in ['bed', 'bed', 'bam']]
+                handle.write('\t'.join([bam] + files) + '\n')
+                outputs.append(files)
+
+                files = [get_temp_file_name(extension=ext) for ext in ['bed', 'bed', 'bam']]
+                metrics = xlsites.run(bam, *files)
+                expected.append((files, metrics))
+
+        all_metrics = xlsites_batch.run(manifest, processes=2)
+
+        self.assertEqual(len(all_metrics), 2)
+        for (expected_files, expected_metrics), files, metrics in zip(expected, outputs, all_metrics):
+            for expected_fname, fname in zip(expected_files[:2], files[:2]):
+                with open(expected_fname) as expected_handle, open(fname) as handle:
+                    self.assertEqual(handle.read(), expected_handle.read())
+            for name in ['all_recs', 'used_recs', 'strange_recs', 'bc_cn']:
+                self.assertEqual(getattr(metrics, name), getattr(expected_metrics, name))
+
+    def test_cram_without_reference(self):
+        manifest = get_temp_file_name(extension='tsv')
+        with open(manifest, 'wt') as handle:
+            files = [get_temp_file_name(extension=ext) for ext in ['bam', 'bed', 'bed', 'cram']]
+            handle.write('\t'.join(files) + '\n')
+        with self.assertRaisesRegex(ValueError, 'reference is needed'):
+            xlsites_batch.run(manifest)
+
+
+if __name__ == '__main__':
+    unittest.main()
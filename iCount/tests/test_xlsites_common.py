@@ -0,0 +1,192 @@
+# pylint: disable=missing-docstring, protected-access
+
+import gzip
+import warnings
+import unittest
+
+from iCount.mapping import xlsites_common
+from iCount.tests.utils import get_temp_file_name
+
+
+class TestSaveDict(unittest.TestCase):
+
+    def setUp(self):
+        self.bed = {
+            ('chr2', '+'): {5: [1.5, 2]},
+            ('chr1', '-'): {20: [0.25, 1], 3: [1, 1]},
+            ('chr1', '+'): {20: [2, 3], 100: [1, 1]},
+        }
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_sorted(self):
+        out_fname = get_temp_file_name(extension='bed')
+        xlsites_common._save_dict(self.bed, out_fname, val_index=0)
+        with open(out_fname) as handle:
+            self.assertEqual(handle.read(), (
+                'chr1\t3\t4\t.\t1\t-\n'
+                'chr1\t20\t21\t.\t2\t+\n'
+                'chr1\t20\t21\t.\t0.25\t-\n'
+                'chr1\t100\t101\t.\t1\t+\n'
+                'chr2\t5\t6\t.\t1.5\t+\n'
+            ))
+
+    def test_gzip(self):
+        out_fname = get_temp_file_name(extension='bed.gz')
+        xlsites_common._save_dict(self.bed, out_fname, val_index=1)
+        with gzip.open(out_fname, 'rt') as handle:
+            self.assertEqual(handle.readline(), 'chr1\t3\t4\t.\t1\t-\n')
+
+
+class TestUpdate(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_match_basic(self):
+        cur_vals = {
+            'A': [1, 2, 3],
+            'B': [4, 5, 0],
+        }
+        to_add = {
+            'A': [1, 0, 1],
+            'C': [42, 2, 3],
+        }
+
+        expected = {
+            'A': [2, 2, 4],
+            'B': [4, 5, 0],
+            'C': [42, 2, 3],
+        }
+        xlsites_common._update(cur_vals, to_add)
+        self.assertEqual(expected, cur_vals)
+
+
+class TestCollapse(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_start_1(self):
+        """
+        Two barcodes, one with two second_start groups.
+        No multimax situation yet.
+        """
+        by_bc = {
+            'AAAAA': [
+                # (middle_pos, end_pos, read_len, num_mapped, cigar, second_start)
+                (5, 10, 10, 1, 0),
+                (5, 10, 10, 1, 0),
+                (5, 30, 20, 1, 20),
+            ],
+            'CCCCC': [
+                (5, 10, 10, 1, 0),
+                (5, 10, 10, 1, 0),
+            ],
+        }
+        result1 = xlsites_common._collapse(1, by_bc, 'start', multimax=1)
+        expected1 = {1: (3.0, 5)}
+        self.assertEqual(result1, expected1)
+
+    def test_start_2(self):
+        """
+        Two barcodes, multimax case.
+        """
+        by_bc = {
+            'AAAAA': [
+                # (middle_pos, end_pos, read_len, num_mapped, cigar, second_start)
+                (5, 10, 10, 1, 0),
+                (5, 10, 10, 1, 0),
+                (15, 30, 20, 2, 0),
+            ],
+            'CCCCC': [
+                (5, 10, 10, 1, 0),
+                (5, 10, 10, 100, 0),  # Excluded becouse of multimax
+            ],
+        }
+        result1 = xlsites_common._collapse(1, by_bc, 'start', multimax=10)
+        expected1 = {1: (1.75, 4)}
+        self.assertEqual(result1, expected1)
+
+    def test_middle(self):
+        xlink_pos = 1
+        report_by = 'middle'
+        by_bc = {
+            'AAAAA': [
+                # (middle_pos, end_pos, read_len, num_mapped, cigar, second_start)
+                (5, 10, 10, 1, 0),
+                (5, 10, 10, 1, 0),
+                (40, 80, 80, 8, 0)],
+            'CCCCC': [
+                (5, 10, 10, 1, 0),
+                (25, 30, 10, 10, 0)]}
+
+        # Multimax = 1
+        result1 = xlsites_common._collapse(xlink_pos, by_bc, report_by, multimax=1)
+        expected1 = {5: (2.0, 3)}
+        self.assertEqual(result1, expected1)
+
+        # Multimax = 10
+        result2 = xlsites_common._collapse(xlink_pos, by_bc, report_by, multimax=10)
+        expected2 = {5: (0.7, 3), 40: (0.1, 1), 25: (0.05, 1)}
+        self.assertEqual(result2, expected2)
+
+    def test_end(self):
+        xlink_pos = 1
+        report_by = 'end'
+        by_bc = {
+            'AAAAA': [
+                # (middle_pos, end_pos, read_len, num_mapped, cigar, second_start)
+                (1, 10, 10, 1, 0),
+                (1, 10, 10, 1, 0),
+                (1, 80, 80, 8, 0),
+            ],
+            'CCCCC': [
+                (1, 10, 10, 1, 0),
+                (15, 20, 10, 10, 0),
+            ],
+        }
+
+        # Multimax = 1
+        result1 = xlsites_common._collapse(xlink_pos, by_bc, report_by, multimax=1)
+        expected1 = {10: (2.0, 3)}
+        self.assertEqual(result1, expected1)
+
+        # Multimax = 10
+        result2 = xlsites_common._collapse(xlink_pos, by_bc, report_by, multimax=10)
+        expected2 = {10: (0.7, 3), 80: (0.1, 1), 20: (0.05, 1)}
+        self.assertEqual(result2, expected2)
+
+
+class TestCollapseTiers(unittest.TestCase):
+
+    def setUp(self):
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_tiers(self):
+        by_bc = {
+            'AAAAA': [
+                # (middle_pos, end_pos, read_len, num_mapped, second_start)
+                (5, 10, 10, 1, 0),
+                (5, 10, 10, 3, 0),
+                (6, 30, 20, 1, 20),
+                (6, 30, 25, 10, 20),
+            ],
+            'CCCCC': [
+                (5, 10, 10, 2, 0),
+                (7, 12, 12, 5, 0),
+            ],
+        }
+        tiers = xlsites_common._collapse_tiers(1, by_bc, 'middle', [1, 3, 5, 50])
+        expected = [
+            {5: (1.0, 1), 6: (1.0, 1)},
+            {5: (1.1667, 3), 6: (1.0, 1)},
+            {5: (0.8939, 3), 6: (1.0, 1), 7: (0.1091, 1)},
+            {5: (0.8939, 3), 6: (0.5, 2), 7: (0.1091, 1)},
+        ]
+        tiers = [{pos: (round(cdna, 4), reads) for pos, (cdna, reads) in counts.items()}
+                 for counts in tiers]
+        self.assertEqual(tiers, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()